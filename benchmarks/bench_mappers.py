@@ -0,0 +1,243 @@
+"""
+Benchmarks for map building and action dispatch of the file mappers.
+
+Run all benchmarks for trees with 1000 and 10000 files and save the results:
+
+    python benchmarks/bench_mappers.py --sizes 1000,10000 --output results.json
+
+Compare the results of two runs (e.g. of two commits):
+
+    python benchmarks/bench_mappers.py --compare old.json new.json
+
+Each benchmark runs in a forked process, so the reported peak memory
+(maximum resident set size) belongs to that benchmark only.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from timeit import default_timer
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import doitfilemappers.filemappers as fm
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+FILES_PER_DIR = 1000
+EXTENSIONS = ["csv", "txt", "dat"]
+
+def create_tree(root, size):
+    """ Create size empty files in subdirectories of root, with FILES_PER_DIR files per directory. """
+    for i in range(size):
+        if i % FILES_PER_DIR == 0:
+            directory = os.path.join(root, "d{:05d}".format(i // FILES_PER_DIR))
+            os.makedirs(directory)
+        name = "f{:07d}.{}".format(i, EXTENSIONS[i % len(EXTENSIONS)])
+        open(os.path.join(directory, name), "w").close()
+
+def get_tree(base_dir, size):
+    """ Return the root of a tree with size files, creating it if it does not exist yet. """
+    root = os.path.join(base_dir, "tree{}".format(size))
+    if not os.path.exists(root):
+        tmp_root = root + ".tmp"
+        if os.path.exists(tmp_root):
+            shutil.rmtree(tmp_root)
+        os.makedirs(tmp_root)
+        create_tree(tmp_root, size)
+        os.rename(tmp_root, root)
+    return root
+
+def noop(source, target):
+    return True
+
+MAPPERS = {
+    "IdentityMapper": lambda root: fm.IdentityMapper("**/*", in_path=root),
+    "RegexMapper": lambda root: fm.RegexMapper("**/*", search=r"^(.*)/f(\d+)\.csv$", replace=r"\1/out\2.json", in_path=root),
+    "GlobMapper": lambda root: fm.GlobMapper("**/*.csv", None, "*.json", "*.csv", in_path=root),
+    "MergeMapper": lambda root: fm.MergeMapper("**/*", target="merged.out", in_path=root),
+    "CompositeMapper": lambda root: fm.CompositeMapper([
+        fm.GlobMapper("**/*", replace="*.json", pattern="*.csv", in_path=root),
+        fm.GlobMapper("**/*", replace="*.html", pattern="*.txt", in_path=root),
+        fm.GlobMapper("**/*", replace="*.bin", pattern="*.dat", in_path=root),
+    ]),
+    "ChainedMapper": lambda root: fm.ChainedMapper("**/*.csv", callback=noop, in_path=root, sub_mappers=[
+        fm.GlobMapper(replace="*.tmp", pattern="*.csv"),
+        fm.GlobMapper(replace="*.json", pattern="*.tmp"),
+    ]),
+}
+
+def bench_map(mapper_name, root):
+    mapper = MAPPERS[mapper_name](root)
+    start = default_timer()
+    mapper.get_map()
+    return default_timer() - start
+
+def bench_get_task(mapper_name, root):
+    mapper = MAPPERS[mapper_name](root)
+    mapper.get_map()
+    mapper.callback = noop
+    start = default_timer()
+    task = mapper.get_task()
+    if mapper_name == "ChainedMapper":
+        list(task)
+    return default_timer() - start
+
+def bench_dispatch(mapper_name, root):
+    mapper = MAPPERS[mapper_name](root)
+    mapper.callback = noop
+    action = mapper.get_action(noop)
+    start = default_timer()
+    action([])
+    return default_timer() - start
+
+BENCHMARKS = {
+    "map": bench_map,
+    "get_task": bench_get_task,
+    "dispatch": bench_dispatch,
+}
+
+def peak_memory_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak //= 1024
+    return peak
+
+def _run_in_child(connection, benchmark, mapper_name, root):
+    try:
+        seconds = BENCHMARKS[benchmark](mapper_name, root)
+        connection.send((seconds, peak_memory_kb(), None))
+    except Exception as e:
+        connection.send((None, peak_memory_kb(), "{}: {}".format(type(e).__name__, e)))
+    connection.close()
+
+def run_case(benchmark, mapper_name, root):
+    """ Run a benchmark in a new process and return the time, peak memory and error. """
+    receiver, sender = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=_run_in_child, args=(sender, benchmark, mapper_name, root))
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+def git_commit():
+    try:
+        output = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        return output.decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(sizes, benchmarks, mappers, repeat, tree_dir):
+    results = []
+    for size in sizes:
+        print("Preparing tree with {} files ...".format(size), file=sys.stderr)
+        root = get_tree(tree_dir, size)
+        for benchmark in benchmarks:
+            for mapper_name in mappers:
+                timings = []
+                peaks = []
+                error = None
+                for i in range(repeat):
+                    seconds, peak, error = run_case(benchmark, mapper_name, root)
+                    if error:
+                        break
+                    timings.append(seconds)
+                    peaks.append(peak)
+                result = {
+                    "case": "{}/{}".format(benchmark, mapper_name),
+                    "size": size,
+                    "seconds": min(timings) if timings else None,
+                    "peak_rss_kb": max(peaks) if peaks and None not in peaks else None,
+                    "error": error,
+                }
+                results.append(result)
+                print("{case:32} {size:>8} {seconds:>10} {peak_rss_kb:>10} {error}".format(
+                    **dict(result, seconds="{:.4f}".format(result["seconds"]) if timings else "-")),
+                    file=sys.stderr)
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+def compare(old_file, new_file, threshold):
+    """ Print the ratios between two result files and return the number of regressions. """
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    old_results = dict(((r["case"], r["size"]), r) for r in old["results"])
+    regressions = 0
+    print("{:32} {:>8} {:>10} {:>10} {:>8} {:>8}".format("case", "size", "old s", "new s", "time", "memory"))
+    for result in new["results"]:
+        key = (result["case"], result["size"])
+        if key not in old_results or not result["seconds"] or not old_results[key]["seconds"]:
+            continue
+        previous = old_results[key]
+        time_ratio = result["seconds"] / previous["seconds"]
+        memory_ratio = None
+        if result["peak_rss_kb"] and previous["peak_rss_kb"]:
+            memory_ratio = float(result["peak_rss_kb"]) / previous["peak_rss_kb"]
+        marker = ""
+        if time_ratio > threshold or (memory_ratio or 0) > threshold:
+            regressions += 1
+            marker = "  <- regression"
+        print("{:32} {:>8} {:>10.4f} {:>10.4f} {:>7.2f}x {:>8}{}".format(
+            result["case"], result["size"], previous["seconds"], result["seconds"], time_ratio,
+            "{:.2f}x".format(memory_ratio) if memory_ratio else "-", marker))
+    return regressions
+
+def parse_list(value):
+    return [v for v in value.split(",") if v]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES),
+        help="Comma separated numbers of files, e.g. 1000,10000,1000000")
+    parser.add_argument("--benchmarks", default=",".join(sorted(BENCHMARKS)),
+        help="Comma separated benchmarks to run: " + ", ".join(sorted(BENCHMARKS)))
+    parser.add_argument("--mappers", default=",".join(sorted(MAPPERS)),
+        help="Comma separated mapper classes to benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs of each benchmark, the fastest run is reported")
+    parser.add_argument("--tree-dir", help="Directory for the generated trees, reused between runs. Defaults to a temporary directory.")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files")
+    parser.add_argument("--threshold", type=float, default=1.2,
+        help="Ratio above which --compare reports a regression (default: 1.2)")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return 1 if compare(args.compare[0], args.compare[1], args.threshold) else 0
+
+    tree_dir = args.tree_dir or tempfile.mkdtemp(prefix="filemapper-bench-")
+    try:
+        results = run([int(s) for s in parse_list(args.sizes)], parse_list(args.benchmarks),
+            parse_list(args.mappers), args.repeat, tree_dir)
+    finally:
+        if not args.tree_dir:
+            shutil.rmtree(tree_dir)
+    output = json.dumps(results, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,2 +1 @@
-from filemappers import IdentityMapper
-
+from .filemappers import IdentityMapper
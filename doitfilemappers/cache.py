@@ -0,0 +1,218 @@
+"""
+Content-addressed cache for the target files of mapper actions.
+
+The cache key of a target is a hash of the content of its source file, a
+fingerprint of the callback and the mapper parameters. Different working
+directories or checkouts that process the same file contents with the same
+callback share the cached targets, regardless of their paths.
+"""
+import hashlib
+import os
+import shutil
+import threading
+from functools import partial
+
+RESTORE_MODES = ("copy", "link")
+SIMPLE_TYPES = (str, bytes, int, float, bool, tuple, type(None))
+MAX_FINGERPRINT_DEPTH = 5
+
+def callback_fingerprint(callback, depth=0):
+    """
+    Return a string that identifies what callback does.
+
+    Objects can provide their own fingerprint in a `cache_fingerprint`
+    attribute. For functions the fingerprint contains the name, a hash of
+    the byte code and constants and the fingerprints of the functions and
+    simple values in its closure, so decorated callbacks (e.g. with
+    `open_files`) are identified by the decorated function and its options.
+    """
+    fingerprint = getattr(callback, "cache_fingerprint", None)
+    if fingerprint is not None:
+        return fingerprint
+    if isinstance(callback, partial):
+        return "partial({}, {!r}, {!r})".format(callback_fingerprint(callback.func, depth + 1),
+            callback.args, sorted((callback.keywords or {}).items()))
+    name = "{}.{}".format(getattr(callback, "__module__", ""), getattr(callback, "__name__", type(callback).__name__))
+    code = getattr(callback, "__code__", None)
+    if code is None:
+        return name
+    digest = hashlib.sha256()
+    _update_with_code(digest, code)
+    for cell in getattr(callback, "__closure__", None) or ():
+        try:
+            value = cell.cell_contents
+        except ValueError:
+            continue
+        if hasattr(value, "__call__") and depth < MAX_FINGERPRINT_DEPTH:
+            digest.update(callback_fingerprint(value, depth + 1).encode("utf-8"))
+        elif isinstance(value, SIMPLE_TYPES):
+            digest.update(repr(value).encode("utf-8"))
+    return "{}:{}".format(name, digest.hexdigest())
+
+def _update_with_code(digest, code):
+    """ Add the byte code, names and constants of code and its nested functions to digest. """
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode("utf-8"))
+    for const in code.co_consts:
+        if isinstance(const, type(code)):
+            _update_with_code(digest, const)
+        else:
+            digest.update(repr(const).encode("utf-8"))
+
+class OutputCache(object):
+    """
+    Store of cached target files in a local directory.
+
+    Parameters:
+    - path: Directory of the store. It is created when the first file is stored.
+    - max_size: Maximum size of all cached files in bytes. When it is
+      exceeded, the least recently used files are deleted. None means no limit.
+    - restore: How a cached file is restored to its target: `copy` (the
+      default) or `link` for a hard link. If the link can't be created
+      (e.g. on another file system), the file is copied.
+    """
+    def __init__(self, path, max_size=None, restore="copy"):
+        if restore not in RESTORE_MODES:
+            raise RuntimeError("restore must be one of {}.".format(", ".join(RESTORE_MODES)))
+        self.path = str(path)
+        self.max_size = max_size
+        self.restore_mode = restore
+        self._size = None
+        self._lock = threading.Lock()
+
+    def key(self, source, fingerprint, block_size=1024 * 1024):
+        """ Return the cache key for the content of the file source and fingerprint. """
+        digest = hashlib.sha256(fingerprint.encode("utf-8"))
+        digest.update(b"\0")
+        with open(str(source), "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def restore(self, key, target):
+        """
+        Restore the cached file for key to target. Return False if there is no cached file.
+
+        Other processes that share the cache may evict the entry at any
+        time, so a failed copy is treated as a missing entry.
+        """
+        entry = self._entry(key)
+        if not os.path.exists(entry):
+            return False
+        target = str(target)
+        if os.path.lexists(target):
+            os.remove(target)
+        try:
+            if self.restore_mode == "link":
+                try:
+                    os.link(entry, target)
+                except OSError:
+                    shutil.copyfile(entry, target)
+            else:
+                shutil.copyfile(entry, target)
+            # The modification time marks the recently used entries
+            os.utime(entry, None)
+        except (IOError, OSError):
+            if os.path.lexists(target):
+                os.remove(target)
+            return False
+        return True
+
+    def store(self, key, target):
+        """ Add the file target to the cache and evict old entries if the cache is too big. """
+        entry = self._entry(key)
+        directory = os.path.dirname(entry)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        tmp_entry = "{}.{}.{}.tmp".format(entry, os.getpid(), threading.current_thread().ident)
+        shutil.copyfile(str(target), tmp_entry)
+        os.rename(tmp_entry, entry)
+        if self.max_size is None:
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for path, size, mtime in self._list_entries())
+            else:
+                self._size += os.path.getsize(entry)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _list_entries(self):
+        entries = []
+        for directory, dirs, files in os.walk(self.path):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _evict(self):
+        """ Delete the least recently used entries until the cache is smaller than max_size. """
+        entries = sorted(self._list_entries(), key=lambda e: e[2])
+        self._size = sum(size for path, size, mtime in entries)
+        for path, size, mtime in entries:
+            if self._size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+
+    def clear(self):
+        """ Delete all cached files. """
+        with self._lock:
+            if os.path.isdir(self.path):
+                shutil.rmtree(self.path)
+            self._size = None
+
+class CachedCallback(object):
+    """
+    Callback that restores targets from an OutputCache instead of calling callback.
+
+    If a target is not in the cache, callback is called and the target is
+    stored in the cache if the callback did not return False. If callback
+    has a `close` function, it is called with the target before the target
+    is stored. Targets in skip_targets (e.g. targets that are merged from
+    several sources) are never cached.
+    """
+    def __init__(self, cache, callback, parameters="", skip_targets=()):
+        self.cache = cache
+        self.callback = callback
+        self.fingerprint = "{}\n{}".format(callback_fingerprint(callback), parameters)
+        self.skip_targets = set(skip_targets)
+        self.hits = 0
+        self.misses = 0
+        self.close = getattr(callback, "close", None)
+
+    def __call__(self, source, target):
+        if str(target) in self.skip_targets:
+            return self.callback(source, target)
+        key = self.cache.key(source, "{}\n{}".format(self.fingerprint, os.path.basename(str(target))))
+        if self.cache.restore(key, target):
+            self.hits += 1
+            return True
+        self.misses += 1
+        # A restored target can be a hard link to a cache entry, which must
+        # not be overwritten by the callback.
+        if os.path.lexists(str(target)):
+            os.remove(str(target))
+        value = self.callback(source, target)
+        if value != False and self.close is not None:
+            # Flush pooled handles (see open_files_with_merge) before the target is stored
+            self.close(target)
+        if value != False and os.path.isfile(str(target)):
+            self.cache.store(key, target)
+        return value
@@ -1,7 +1,64 @@
 import pathlib
 import re
 import abc
-from collections import defaultdict
+import csv
+import hashlib
+import io
+import errno
+import json
+import mmap
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import heapq
+import multiprocessing
+import multiprocessing.pool
+from array import array
+from collections import defaultdict, deque, OrderedDict
+from functools import partial
+from timeit import default_timer
+from .walker import FileWalker, shared_index
+from .cache import OutputCache, CachedCallback, callback_fingerprint
+
+try:
+    from shlex import quote as shell_quote
+except ImportError:
+    from pipes import quote as shell_quote
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+EXECUTION_MODES = ("serial", "thread", "process")
+INCREMENTAL_MODES = ("mtime", "hash")
+DEFAULT_ASYNC_CONCURRENCY = 16
+# Linux limits a single argument (like the command string for `sh -c`) to 128 KiB
+MAX_ARG_STRLEN = 131072
+# Write buffer for the target files that open_files_with_merge keeps open
+MERGE_BUFFER_SIZE = 1024 * 1024
+RECORD_TYPES = ("line", "csv", "chunk")
+COLLISION_MODES = ("ignore", "error", "merge")
+ORDER_MODES = ("largest_first",)
+# How many levels of wrapped callbacks are searched for shared counters
+MAX_WRAPPER_DEPTH = 5
 
 class BaseFileMapper(object):
     __metaclass__  = abc.ABCMeta
@@ -20,15 +77,63 @@ class BaseFileMapper(object):
         self.allow_empty_map = config.get("allow_empty_map", False)
         self.task = config.get("task", {})
         self.error_handling = config.get("error_handling", ((Exception), self._handle_exception ))
+        self.execution = config.get("execution", "serial")
+        self.workers = config.get("workers", None)
+        self.chunk_size = config.get("chunk_size", 1)
+        self.incremental = config.get("incremental", False)
+        self.state_file = config.get("state_file", ".filemappers-state.json")
+        self.walker = config.get("walker", None)
+        if self.walker == True:
+            self.walker = FileWalker()
+        self.order = config.get("order", None)
+        if self.order is not None and self.order not in ORDER_MODES:
+            raise RuntimeError("order must be one of {}.".format(", ".join(ORDER_MODES)))
+        self.compact_map = config.get("compact_map", False)
+        self.batch_size = config.get("batch_size", None)
+        self.on_start = config.get("on_start", None)
+        self.on_finish = config.get("on_finish", None)
+        self.stats_report = config.get("stats_report", None)
+        self.map_build_time = None
+        self.index = config.get("index", None)
+        if self.index == True:
+            self.index = shared_index
+        if self.index is not None:
+            # Without a walker, keep the semantics of the pathlib glob
+            walker = self.walker or FileWalker(file_type="any", follow_symlinks=True)
+            self.walker = walker.with_index(self.index)
+        self.partition = config.get("partition", None)
+        if self.partition == True:
+            self.partition = _partition_from_environment()
+        if self.partition is not None:
+            index, count = self.partition
+            if count < 1 or not 0 <= index < count:
+                raise RuntimeError("partition must be an (index, count) tuple with 0 <= index < count.")
+        self.failure_manifest = config.get("failure_manifest", None)
+        if self.failure_manifest:
+            self.failure_manifest = str(self.failure_manifest)
+        self.retry_failed = config.get("retry_failed", False)
+        if self.retry_failed and not self.failure_manifest:
+            raise RuntimeError("retry_failed needs the failure_manifest parameter.")
+        self.cache = config.get("cache", None)
+        if isinstance(self.cache, basestring):
+            self.cache = OutputCache(self.cache)
+        self.partition_manifest = str(config.get("partition_manifest", ".filemappers-partition-{index}-of-{count}.json"))
 
     def get_map(self):
         """
         Return a list of (source, target) tuples.
 
-        Each source and target is an instance of Path.
+        Each source and target is an instance of Path. If `compact_map` is
+        set, a CompactMap is returned instead of a list.
         """
         if not self.map_initialized:
+            start = default_timer()
             self.map = self._create_map(self.src)
+            if self.partition is not None:
+                self.map = self._select_partition(self.map, self.partition[0])
+            if self.compact_map and not isinstance(self.map, CompactMap):
+                self.map = CompactMap(self.map)
+            self.map_build_time = default_timer() - start
             self.map_initialized = True
         return self.map
 
@@ -36,38 +141,490 @@ class BaseFileMapper(object):
     def _create_map(self, src):
         """ Create the mapping that specific for this mapping class. """
 
-    def get_action(self, callback):
+    def _select_partition(self, file_map, index):
+        """ Return the pairs of file_map that belong to partition index. """
+        selected = set()
+        for pairs in _group_by_target(file_map):
+            if self._get_partition_of(pairs) == index:
+                selected.add(str(pairs[0][1]))
+        partition_map = self._new_map()
+        for source, target in file_map:
+            if str(target) in selected:
+                partition_map.append((source, target))
+        return partition_map
+
+    def _get_partition_of(self, pairs):
         """
-        Return a function that iterates over the map, calling the callback.
+        Return the partition of the pairs of a target.
 
-        The `targets` parameter of the generated function is ignored.
+        The partition is computed from the MD5 hash of the first source path
+        (relative to `in_path`), so it's the same on all nodes.
         """
-        file_map = self.get_map()
+        in_path = str(self.in_path)
+        source = min(os.path.relpath(str(s), in_path).replace(os.sep, "/") for s, t in pairs)
+        digest = hashlib.md5(source.encode("utf-8")).hexdigest()
+        return int(digest, 16) % self.partition[1]
 
-        def ok_value(v, ok):
-            if v == False or ok == False:
-                return False
-            else:
-                return True
+    def _get_manifest_name(self, index):
+        return self.partition_manifest.format(index=index, count=self.partition[1])
+
+    def _write_partition_manifest(self, done, failed):
+        """
+        Add the completed and failed targets of this partition to its manifest.
+
+        The targets of earlier actions (e.g. of other sub-tasks) are kept.
+        The manifest is locked during the update, so sub-tasks that run in
+        parallel don't overwrite each other's targets.
+        """
+        index, count = self.partition
+        def update(manifest):
+            completed = (set(manifest.get("completed", [])) | done) - failed
+            return {
+                "index": index,
+                "count": count,
+                "completed": sorted(completed),
+                "failed": sorted((set(manifest.get("failed", [])) - completed) | failed),
+            }
+        _update_json(self._get_manifest_name(index), update)
+
+    def _write_failure_manifest(self, failures, unfinished, run_targets):
+        """
+        Update the failure manifest with the failed and unfinished pairs of an action.
+
+        The entries of targets that were not in run_targets (e.g. of other
+        sub-tasks) are kept. The manifest is deleted if no entries are left.
+        """
+        def update(manifest):
+            # Errors without a pair are only kept until the next update
+            failed = [e for e in manifest.get("failed", []) if e["target"] is not None and e["target"] not in run_targets]
+            failed += failures
+            unfinished_entries = [e for e in manifest.get("unfinished", []) if e["target"] not in run_targets]
+            unfinished_entries += [{"source": s, "target": t} for s, t in unfinished]
+            if not failed and not unfinished_entries:
+                return None
+            return {"failed": failed, "unfinished": unfinished_entries}
+        _update_json(self.failure_manifest, update)
+
+    def _select_failed(self, file_map):
+        """
+        Return the pairs of file_map whose target is listed in the failure manifest.
+
+        All pairs of a listed target are returned, so merged targets are
+        rebuilt completely. If there is no manifest, file_map is returned.
+        """
+        try:
+            with open(self.failure_manifest) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return file_map
+        retry = set(entry["target"] for entry in manifest["failed"] + manifest["unfinished"] if entry["target"])
+        return [(s, t) for s, t in file_map if str(t) in retry]
+
+    def verify_partition_coverage(self):
+        """
+        Check the manifests of all partitions.
+
+        Return a list of the targets of the complete map that were not
+        completed by any partition, in map order. An empty list means that
+        all partitions have finished successfully.
+        """
+        if self.partition is None:
+            raise RuntimeError("verify_partition_coverage needs the partition parameter.")
+        completed = set()
+        for index in range(self.partition[1]):
+            try:
+                with open(self._get_manifest_name(index)) as f:
+                    completed.update(json.load(f)["completed"])
+            except (IOError, ValueError, KeyError):
+                continue
+        missing = OrderedDict()
+        for source, target in _iter_names(self._create_map(self.src)):
+            if target not in completed:
+                missing[target] = True
+        return list(missing)
+
+    def _new_map(self):
+        """ Return an empty map container for _create_map. """
+        if self.compact_map:
+            return CompactMap()
+        return []
+
+    def get_action(self, callback, file_map=None):
+        """
+        Return a function that iterates over the map, calling the callback.
+
+        The `targets` parameter of the generated function is ignored. If
+        file_map is given, it is used instead of the map of the mapper.
+        """
+        if self.execution not in EXECUTION_MODES:
+            raise RuntimeError("execution must be one of {}.".format(", ".join(EXECUTION_MODES)))
+        if self.incremental and self.incremental not in INCREMENTAL_MODES:
+            raise RuntimeError("incremental must be one of {}.".format(", ".join(INCREMENTAL_MODES)))
+        if file_map is None:
+            file_map = self.get_map()
 
         def task_action(targets):
             ok = True
-            for source, target in file_map:
-                try:
-                    ok = ok_value(callback(source, target), ok)
-                except self.error_handling[0] as e:
-                    ok = ok_value(self.error_handling[1](e), ok)
+            run_map, digests = file_map, None
+            if self.retry_failed:
+                run_map = self._select_failed(run_map)
+            if self.incremental:
+                run_map, digests = self._check_freshness(run_map, self.incremental)
+            pending = defaultdict(lambda: 0)
+            for source, target in run_map:
+                pending[str(target)] += 1
+            completed = set()
+            failed = set()
+            failures = []
+            started_map = run_map
+            stats = None
+            if self.on_start or self.on_finish or self.stats_report:
+                stats = ActionStats(self)
+                run_map = stats.announce(run_map)
+            results = self._iter_results(callback, run_map)
+            try:
+                for source, target, value, error, seconds in results:
+                    if stats is not None:
+                        stats.add(source, target, value, error, seconds)
+                    ok = _ok_value(value, ok)
+                    target_name = str(target)
+                    if value == False or error is not None:
+                        failed.add(target_name)
+                        if self.failure_manifest:
+                            failures.append(_failure_entry(source, target, error))
+                    pending[target_name] -= 1
+                    if pending[target_name] == 0:
+                        completed.add(target_name)
+            except Exception as e:
+                if stats is not None:
+                    stats.unhandled_error = _error_name(e)
+                if self.failure_manifest:
+                    failures.append(_failure_entry(None, None, e))
+                raise
+            finally:
+                results.close()
+                close = getattr(callback, "close", None)
+                if close is not None:
+                    close()
+                if stats is not None:
+                    stats.finish()
+                    if self.stats_report:
+                        stats.write_report(self.stats_report, set(t for s, t in _iter_names(file_map)))
+                if digests is not None:
+                    HashState(self.state_file).update(
+                        dict((t, digests[t]) for t in completed - failed)
+                    )
+                if self.partition is not None:
+                    # Targets that were up to date are completed too
+                    not_done = set(pending) - (completed - failed)
+                    done = set(t for s, t in _iter_names(file_map)) - not_done
+                    self._write_partition_manifest(done, failed)
+                if self.failure_manifest:
+                    unfinished = [(s, t) for s, t in _iter_names(started_map) if pending[t] > 0]
+                    self._write_failure_manifest(failures, unfinished, set(pending))
             return ok
         return task_action
 
-    def get_cmd_action(self, cmd):
+    def get_stale_map(self):
+        """
+        Return the pairs of the map whose target is missing or out of date.
+
+        If one source of a target is out of date, all pairs with that
+        target are returned, so merged targets are rebuilt completely.
+        """
+        return self._check_freshness(self.get_map(), self.incremental or "mtime")[0]
+
+    def uptodate(self, task=None, values=None):
+        """ Return True if all targets of the map are up to date. Can be used in the `uptodate` list of a task. """
+        return not self.get_stale_map()
+
+    def _check_freshness(self, file_map, mode):
+        """
+        Split off the stale pairs of file_map.
+
+        Return a tuple of the stale pairs and, in hash mode, a dictionary
+        with the source digests of each stale target.
+        """
+        if any(s == t for s, t in _iter_names(file_map)):
+            # A file that is its own target is always as new as its source
+            raise RuntimeError("incremental can't be used for pairs whose source is the target, e.g. of an IdentityMapper.")
+        groups = _group_by_target(file_map)
+        stale = []
+        if mode == "hash":
+            state = HashState(self.state_file).load()
+            digests = {}
+            for pairs in groups:
+                target_name = str(pairs[0][1])
+                sources = dict((str(s), file_digest(s)) for s, t in pairs)
+                if not pairs[0][1].exists() or state.get(target_name) != sources:
+                    stale += pairs
+                    digests[target_name] = sources
+            return stale, digests
+        for pairs in groups:
+            if not _is_fresh_by_mtime(pairs):
+                stale += pairs
+        return stale, None
+
+    def _iter_results(self, callback, file_map):
+        """
+        Call the callback for each pair of file_map and yield the results.
+
+        Yields (source, target, value, error, seconds) tuples. If the
+        callback raised a handled exception, error contains the exception and
+        value contains the return value of the error handler. seconds is the
+        time the callback took.
+        """
+        if self.order and (self.execution == "serial" or _is_async_callback(callback)):
+            file_map = [pair for pairs in self._order_groups(_group_by_target(file_map)) for pair in pairs]
+        if _is_async_callback(callback):
+            return self._iter_async_results(callback, file_map)
+        if self.execution == "serial":
+            return self._iter_serial_results(callback, file_map)
+        return self._iter_pooled_results(callback, file_map)
+
+    def _get_source_size(self, source):
+        """ Return the size of source, from the sizes collected by the walker if possible. """
+        size = getattr(self.walker, "sizes", {}).get(str(source))
+        if size is None:
+            size = _file_size(source) or 0
+        return size
+
+    def _get_group_sizes(self, groups):
+        return [sum(self._get_source_size(s) for s, t in pairs) for pairs in groups]
+
+    def _order_groups(self, groups):
+        """ Return the pair groups sorted by the size of their sources, largest first. """
+        sizes = self._get_group_sizes(groups)
+        return [groups[i] for i in sorted(range(len(groups)), key=lambda i: -sizes[i])]
+
+    def _split_map(self, file_map, shard_size, by_directory):
+        """ Split file_map into (name, pairs) shards, balanced by source size if `order` is set. """
+        if not self.order or by_directory:
+            return _split_map(file_map, shard_size, by_directory)
+        groups = _group_by_target(file_map)
+        if shard_size <= 1:
+            return [(str(pairs[0][1]), pairs) for pairs in self._order_groups(groups)]
+        pair_count = sum(len(pairs) for pairs in groups)
+        shards = self._pack_groups(groups, (pair_count + shard_size - 1) // shard_size)
+        return [("shard{}".format(i + 1), shard) for i, shard in enumerate(shards)]
+
+    def _pack_groups(self, groups, bin_count, capacity=None):
+        """ Distribute the pair groups over bin_count lists of pairs with similar source sizes. """
+        bins = _pack_balanced(groups, self._get_group_sizes(groups), bin_count, capacity)
+        return [[pair for pairs in groups_of_bin for pair in pairs] for groups_of_bin in bins]
+
+    def _iter_serial_results(self, callback, file_map):
+        for source, target in file_map:
+            start = default_timer()
+            try:
+                value, error = callback(source, target), None
+            except self.error_handling[0] as e:
+                seconds = default_timer() - start
+                value, error = self.error_handling[1](e), e
+            else:
+                seconds = default_timer() - start
+            yield source, target, value, error, seconds
+
+    def _iter_async_results(self, callback, file_map):
+        """
+        Run the coroutines returned by callback on an event loop.
+
+        At most `workers` coroutines run at the same time. The results are
+        yielded in the order the coroutines finish.
+        """
+        if asyncio is None:
+            raise RuntimeError("Coroutine callbacks need the asyncio module.")
+        limit = self.workers or DEFAULT_ASYNC_CONCURRENCY
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        pairs = iter(file_map)
+        running = {}
+        try:
+            while True:
+                while len(running) < limit:
+                    pair = next(pairs, None)
+                    if pair is None:
+                        break
+                    running[_start_coroutine(loop, callback, pair)] = (pair, default_timer())
+                if not running:
+                    break
+                done, pending = loop.run_until_complete(
+                    asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED)
+                )
+                finished = default_timer()
+                for future in done:
+                    (source, target), start = running.pop(future)
+                    try:
+                        value, error = future.result(), None
+                    except self.error_handling[0] as e:
+                        value, error = self.error_handling[1](e), e
+                    yield source, target, value, error, finished - start
+        finally:
+            for future in running:
+                future.cancel()
+            if running:
+                loop.run_until_complete(asyncio.wait(list(running)))
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def _iter_pooled_results(self, callback, file_map):
+        """
+        Distribute the map over a thread or process pool.
+
+        Pairs with the same target are sent to the same worker as one work
+        item and are processed in map order, so merging callbacks still see
+        the first source for a target first.
+        """
+        handled_exceptions = self.error_handling[0]
+        work_items = _group_by_target(file_map)
+        chunk_size = self.chunk_size
+        if self.order and chunk_size > 1:
+            # Each work item is a chunk with groups of similar total size
+            bin_count = (len(work_items) + chunk_size - 1) // chunk_size
+            work_items = self._pack_groups(work_items, bin_count, chunk_size)
+            chunk_size = 1
+        elif self.order:
+            work_items = self._order_groups(work_items)
+        if self.execution == "thread":
+            pool = multiprocessing.pool.ThreadPool(self.workers)
+            call = partial(_call_pairs, callback, handled_exceptions)
+        else:
+            # The callback is handed to the workers when they are forked,
+            # so it does not need to be picklable.
+            context = _fork_context()
+            _share_between_processes(callback)
+            pool = context.Pool(self.workers, _init_worker, (callback, handled_exceptions))
+            call = _call_pairs_in_worker
+        finished = False
+        try:
+            for results in pool.imap_unordered(call, work_items, chunk_size):
+                for source, target, value, error, seconds in results:
+                    if error is not None:
+                        value = self.error_handling[1](error)
+                    yield source, target, value, error, seconds
+            finished = True
+        finally:
+            if finished:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+
+    def get_cmd_action(self, cmd, file_map=None):
         """
         Return a list of commands that can be used as action for a task.
 
         Placeholders `%%(target)s` and `%%(source)s` in the `cmd` parameter will be replaced.
+        If `cmd` contains the placeholders `%%(sources)s` or `%%(targets)s`,
+        one command is created for each batch of pairs.
+
+        If `execution` is not `serial`, the list contains a single action
+        that runs the commands in parallel. With `incremental` or
+        `retry_failed`, the list contains a single action that selects the pairs when it runs and runs
+        a command for each of them. If file_map is given, it is used instead
+        of the map of the mapper.
         """
-        file_map = self.get_map()
-        return [cmd % {'source':m[0], "target":m[1]} for m in file_map]
+        if file_map is None:
+            file_map = self.get_map()
+        if "%(sources)s" in cmd or "%(targets)s" in cmd:
+            if self._selects_pairs_when_run():
+                raise RuntimeError("incremental and retry_failed can't be used with batch commands.")
+            commands = self._get_batch_commands(cmd, file_map)
+        elif self._selects_pairs_when_run():
+            # The pairs to run are only known when the action runs
+            return [self.get_action(CommandCallback(cmd), file_map)]
+        else:
+            if self.order:
+                file_map = [pair for pairs in self._order_groups(_group_by_target(file_map)) for pair in pairs]
+            commands = [cmd % {'source':s, "target":t} for s, t in _iter_names(file_map)]
+        if self.execution != "serial":
+            return [self._get_command_pool_action(commands)]
+        return commands
+
+    def _selects_pairs_when_run(self):
+        """ Return True if the action selects the pairs to run from the map when it runs. """
+        return bool(self.retry_failed or self.incremental)
+
+    def _get_batch_commands(self, cmd, file_map):
+        """
+        Return commands where `%%(sources)s` and `%%(targets)s` are replaced with the quoted file names of a batch of pairs.
+
+        A batch contains at most `batch_size` pairs and its command does not
+        exceed the command line length limit of the system. If `cmd`
+        contains `%%(target)s`, all pairs of a batch have the same target.
+        If `order` is set, the pairs are distributed over the batches so
+        that each batch has a similar total source size.
+        """
+        if "%(source)s" in cmd:
+            raise RuntimeError("%(source)s can't be used together with %(sources)s or %(targets)s.")
+        split_on_target = "%(target)s" in cmd
+        # Each occurrence of a placeholder adds the file names to the command
+        sources_count = cmd.count("%(sources)s")
+        targets_count = cmd.count("%(targets)s")
+        target_count = cmd.count("%(target)s")
+        limit = _command_line_limit()
+        base_length = len(cmd % {"sources": "", "targets": "", "target": ""})
+        commands = []
+        batch = []
+        batch_targets = OrderedDict()
+        length = base_length
+        for source, target, bin_start in self._iter_batch_pairs(file_map, split_on_target):
+            source = shell_quote(source)
+            target = shell_quote(target)
+            source_length = (len(source) + 1) * sources_count
+            target_length = (len(target) + 1) * targets_count
+            new_target = target not in batch_targets
+            if batch and (bin_start or length + source_length + (target_length if new_target else 0) > limit
+                    or (self.batch_size and len(batch) >= self.batch_size)
+                    or (split_on_target and new_target)):
+                commands.append(_render_batch_command(cmd, batch, batch_targets))
+                batch = []
+                batch_targets = OrderedDict()
+                length = base_length
+                new_target = True
+            if not batch:
+                # All pairs of a batch share %(target)s, so it's added once
+                length += len(target) * target_count
+            batch.append(source)
+            batch_targets[target] = True
+            length += source_length + (target_length if new_target else 0)
+        if batch:
+            commands.append(_render_batch_command(cmd, batch, batch_targets))
+        return commands
+
+    def _iter_batch_pairs(self, file_map, split_on_target):
+        """ Yield (source, target, bin_start) name tuples for batching, bin_start is True for the first pair of a size-balanced bin. """
+        if not self.order:
+            for source, target in _iter_names(file_map):
+                yield source, target, False
+            return
+        groups = _group_by_target(file_map)
+        if split_on_target or not self.batch_size:
+            bins = [[pair for pairs in self._order_groups(groups) for pair in pairs]]
+        else:
+            pair_count = sum(len(pairs) for pairs in groups)
+            bins = self._pack_groups(groups, (pair_count + self.batch_size - 1) // self.batch_size, self.batch_size)
+        for pairs in bins:
+            bin_start = True
+            for source, target in pairs:
+                yield str(source), str(target), bin_start
+                bin_start = False
+
+    def _get_command_pool_action(self, commands):
+        """ Return an action that runs the commands with at most `workers` commands at a time. """
+        def cmd_action(targets):
+            ok = True
+            pool = multiprocessing.pool.ThreadPool(self.workers)
+            try:
+                for command, status in pool.imap_unordered(_run_command, commands):
+                    if status != 0:
+                        sys.stderr.write("Command failed with exit status {}: {}\n".format(status, command))
+                        ok = False
+            finally:
+                pool.close()
+                pool.join()
+            return ok
+        return cmd_action
 
     def get_task(self, task={}):
         """ Get a task dictionary for DoIt. """
@@ -77,23 +634,89 @@ class BaseFileMapper(object):
                 return self._get_task_for_empty_map(task)
             else:
                 raise RuntimeError("The generated map is empty. Please check your mapper parameters.")
-        sources, targets = zip(*file_map)
-        task = self._get_task_data(task)
-        task["targets"] = list(set([str(t) for t in targets]))
+        return self._build_task(self._get_task_data(task), file_map)
 
-        callback = self.callback
-        if callback == None:
-            if "action" in task:
-                callback = task["action"]
+    def _get_cached_callback(self, callback, file_map):
+        """
+        Return a CachedCallback for callback.
+
+        Command strings are run by a CommandCallback, so they can be cached
+        too. Batch commands and coroutine callbacks are returned unchanged.
+        Targets with more than one source are not cached.
+        """
+        if not hasattr(callback, "__call__"):
+            if "%(sources)s" in callback or "%(targets)s" in callback:
+                return callback
+            callback = CommandCallback(callback)
+        if _is_async_callback(callback):
+            return callback
+        source_counts = defaultdict(lambda: 0)
+        for source, target in _iter_names(file_map):
+            source_counts[target] += 1
+        merged = [target for target, count in source_counts.items() if count > 1]
+        return CachedCallback(self.cache, callback, self._get_cache_parameters(), merged)
+
+    def _get_cache_parameters(self):
+        """ Return a string with the mapper parameters that are part of the cache key. """
+        return type(self).__name__
+
+    def _get_manifest_action(self, file_map):
+        """ Return an action that writes the partition manifest after the commands have succeeded. """
+        def manifest_action(targets):
+            self._write_partition_manifest(set(t for s, t in _iter_names(file_map)), set())
+            return True
+        return manifest_action
+
+    def get_tasks(self, task={}, shard_size=1, by_directory=False):
+        """
+        Yield named sub-tasks for DoIt, each for a part of the map.
+
+        By default there is one sub-task for each target, named after the
+        target. With shard_size, each sub-task gets at least shard_size pairs
+        and is named `shard1`, `shard2`, etc. If by_directory is true, there
+        is one sub-task for each target directory, named after the directory.
+        All pairs of a target are always in the same sub-task.
+        """
+        file_map = self.get_map()
+        if not file_map:
+            if self.allow_empty_map:
+                empty_task = self._get_task_for_empty_map(self._get_task_data(task))
+                empty_task["name"] = "empty"
+                yield empty_task
+                return
+            else:
+                raise RuntimeError("The generated map is empty. Please check your mapper parameters.")
+        for name, shard_map in self._split_map(file_map, shard_size, by_directory):
+            sub_task = self._build_task(self._get_task_data(task), shard_map)
+            sub_task["name"] = name
+            yield sub_task
+
+    def _build_task(self, task, file_map):
+        """ Add the targets, actions and file dependencies for file_map to task. """
+        task["targets"] = list(OrderedDict.fromkeys(t for s, t in _iter_names(file_map)))
+
+        callback = self._get_callback(task)
+        if self.cache is not None and callback:
+            callback = self._get_cached_callback(callback, file_map)
         if hasattr(callback, "__call__"):
-            task["actions"] = [self.get_action(callback)]
+            task["actions"] = [self.get_action(callback, file_map)]
         elif callback:
-            task["actions"] = self.get_cmd_action(callback)
+            task["actions"] = self.get_cmd_action(callback, file_map)
+            if self.partition is not None and not self._selects_pairs_when_run():
+                task["actions"].append(self._get_manifest_action(file_map))
 
         if self.file_dep:
-            task["file_dep"] = [str(s) for s in sources]
+            task["file_dep"] = list(OrderedDict.fromkeys(s for s, t in _iter_names(file_map)))
         return task
 
+    def _get_callback(self, task):
+        """ Return the callback for the task actions. """
+        callback = self.callback
+        if callback == None:
+            if "action" in task:
+                callback = task["action"]
+        return callback
+
     def _get_task_data(self, p_task):
         """ Collect task data from parameter task, and self.task and return it. """
         task = {}
@@ -117,7 +740,11 @@ class BaseFileMapper(object):
     @src.setter
     def src(self, src):
         if isinstance(src, basestring):
-            self._src = list(pathlib.Path(self.in_path).glob(src))
+            self._src = LazyGlob(self.in_path, src, self.walker)
+            self.map_initialized = False
+            return
+        if isinstance(src, LazyGlob):
+            self._src = src
             self.map_initialized = False
             return
         # Check if src is a list of paths
@@ -141,27 +768,78 @@ class BaseFileMapper(object):
         else:
             self._in_path = pathlib.Path(path)
 
+class LazyGlob(object):
+    """
+    Glob expression for source files that is evaluated when it is iterated.
+
+    The file system is not accessed until the map is built and the found
+    paths are consumed one by one instead of being collected in a list.
+    If a walker (e.g. a FileWalker) is given, its `glob` method is used
+    instead of pathlib.Path.glob.
+    """
+    def __init__(self, path, pattern, walker=None):
+        self.path = path
+        self.pattern = pattern
+        self.walker = walker
+
+    def __iter__(self):
+        if self.walker is not None:
+            return iter(self.walker.glob(self.path, self.pattern))
+        return iter(self.path.glob(self.pattern))
+
+    def __repr__(self):
+        return "LazyGlob({!r}, {!r})".format(str(self.path), self.pattern)
+
 class IdentityMapper(BaseFileMapper):
     def __init__(self, src="*", callback=None, **kwargs):
         super(IdentityMapper, self).__init__(src, callback, **kwargs)
         self.file_dep = kwargs.get("file_dep", False)
 
     def _create_map(self, src):
-        return [(f, f) for f in src]
+        file_map = self._new_map()
+        for f in src:
+            file_map.append((f, f))
+        return file_map
 
 class RegexMapper(BaseFileMapper):
     def __init__(self, src="*", callback=None, search=r".*", replace=r"\0",flags=0, ignore_nonmatching=True, **kwargs):
         super(RegexMapper, self).__init__(src, callback, **kwargs)
         self.pattern = re.compile(search, flags)
+        self.flags = flags
         self.replace = replace
         self.ignore_nonmatching = ignore_nonmatching
+        self._custom_hooks = _overrides_regex_hooks(type(self))
 
     def _create_map(self, src):
-        return [(f, self._get_target_from_source(f)) for f in src if self._source_matches(f)]
+        file_map = self._new_map()
+        if self._custom_hooks:
+            # Subclasses that override the hooks get the source Path
+            for source in src:
+                if self._source_matches(source):
+                    file_map.append((source, self._get_target_from_source(source)))
+            return file_map
+        for source in src:
+            target_name = self._get_target_name(str(source))
+            if target_name is not None:
+                file_map.append((source, pathlib.Path(target_name)))
+        return file_map
+
+    def _get_target_name(self, name):
+        """
+        Return the regular expression substitution of the file name.
+
+        Returns None if the name does not match and ignore_nonmatching is set.
+        Subclasses that override `_source_matches` or `_get_target_from_source`
+        don't use this method.
+        """
+        target_name, count = self.pattern.subn(self.replace, name)
+        if count == 0 and self.ignore_nonmatching:
+            return None
+        return target_name
 
     def _get_target_from_source(self, source):
         """ Return a Path object for the regular expression substition of source. """
-        return pathlib.Path(re.sub(self.pattern, self.replace, str(source)))
+        return pathlib.Path(self.pattern.sub(self.replace, str(source)))
 
     def _source_matches(self, source):
         """
@@ -170,16 +848,22 @@ class RegexMapper(BaseFileMapper):
         """
         return not self.ignore_nonmatching or self.pattern.search(str(source))
 
+    def _get_cache_parameters(self):
+        return "{}:{!r}:{!r}:{}:{}".format(type(self).__name__, self.pattern.pattern, self.replace,
+            self.flags, self.ignore_nonmatching)
+
 class GlobMapper(RegexMapper):
     def __init__(self, src="*", callback=None, replace="*", pattern=None, **kwargs):
         if pattern:
             search = self._get_search_regex(pattern)
         elif isinstance(src, basestring):
             search = self._get_search_regex(src)
+            pattern = src
         else:
             raise RuntimeError("No valid glob search pattern found! You must either provide a glob string in src or via pattern.")
         replace_pattern = replace.replace("*", r"\1", 1)
         super(GlobMapper, self).__init__(src, callback, search, replace_pattern, **kwargs)
+        self.glob_parts = tuple(pattern.split("*", 1))
 
     def _get_search_regex(self, pattern):
         """ Convert the glob pattern expression into a regular expression and return it. """
@@ -198,7 +882,10 @@ class MergeMapper(BaseFileMapper):
 
     def _create_map(self, src):
         target = self.target
-        return [(f, target) for f in src]
+        file_map = self._new_map()
+        for f in src:
+            file_map.append((f, target))
+        return file_map
     
     @property
     def target(self):
@@ -214,44 +901,311 @@ class MergeMapper(BaseFileMapper):
             self._target = pathlib.Path(new_target)
 
 class CompositeMapper(BaseFileMapper):
-    def __init__(self, sub_mappers=[], callback=None, **kwargs):
+    def __init__(self, sub_mappers=[], callback=None, deduplicate=True, on_collision="ignore", **kwargs):
+        if on_collision not in COLLISION_MODES:
+            raise RuntimeError("on_collision must be one of {}.".format(", ".join(COLLISION_MODES)))
         super(CompositeMapper, self).__init__(callback=callback, **kwargs)
         self.sub_mappers = sub_mappers
+        self.deduplicate = deduplicate
+        self.on_collision = on_collision
+        self.collisions = OrderedDict()
 
     def _create_map(self, src):
         """ 
         Create and return map from sub_mappers.
 
-        src is ignored.
+        src is ignored. RegexMappers and GlobMappers that use the same `src`
+        glob are mapped together, so each source file is read from the
+        glob only once and matched against all their patterns.
         """
-        combined_map = []
+        dispatch_groups = OrderedDict()
         for sub_mapper in self.sub_mappers:
-            combined_map += sub_mapper.get_map()
+            if PatternDispatcher.can_dispatch(sub_mapper) and not sub_mapper.map_initialized:
+                key = _source_key(sub_mapper.src)
+                dispatch_groups.setdefault(key, []).append(sub_mapper)
+        for mappers in dispatch_groups.values():
+            maps = PatternDispatcher(mappers).create_maps(mappers[0].src)
+            for mapper, file_map in zip(mappers, maps):
+                mapper.map = file_map
+                mapper.map_initialized = True
+        combined_map = self._new_map()
+        combined_map.extend(self._combine(sub_mapper.get_map() for sub_mapper in self.sub_mappers))
         return combined_map
 
+    def _combine(self, maps):
+        """
+        Return the pairs of all maps as one list.
+
+        Drops pairs that occurred before if `deduplicate` is set and finds
+        targets that are mapped from more than one source file. These are
+        stored in `collisions` (target name -> source names) and handled
+        according to `on_collision`.
+        """
+        seen = set()
+        first_sources = {}
+        self.collisions = OrderedDict()
+        pairs = []
+        for file_map in maps:
+            for source, target in file_map:
+                source_name, target_name = str(source), str(target)
+                if self.deduplicate:
+                    if (source_name, target_name) in seen:
+                        continue
+                    seen.add((source_name, target_name))
+                pairs.append((source, target))
+                if self.on_collision == "ignore":
+                    continue
+                first_source = first_sources.setdefault(target_name, source_name)
+                if first_source != source_name:
+                    self.collisions.setdefault(target_name, [first_source]).append(source_name)
+        if self.collisions and self.on_collision == "error":
+            target_name, sources = next(iter(self.collisions.items()))
+            raise RuntimeError("{} targets are mapped from more than one source, e.g. {} from {}.".format(
+                len(self.collisions), target_name, ", ".join(sources)))
+        if self.collisions and self.on_collision == "merge":
+            pairs = [pair for group in _group_by_target(pairs) for pair in group]
+        return pairs
+
+    def _get_callback(self, task):
+        """ Return the callback, turning an `open_files` callback into an `open_files_with_merge` callback in merge mode. """
+        callback = super(CompositeMapper, self)._get_callback(task)
+        file_modes = getattr(callback, "file_modes", None)
+        if self.on_collision == "merge" and file_modes and file_modes[2] is None:
+            in_mode, out_mode = file_modes[:2]
+            callback = open_files_with_merge(callback.file_callback, in_mode, out_mode, out_mode.replace("w", "a"))
+        return callback
+
+class CompactMap(object):
+    """
+    Memory efficient list of (source, target) pairs.
+
+    The directory part of each path is stored only once in a table, the
+    entries only store an index into that table and the file name. The
+    Path instances are created when the map is iterated.
+    """
+    __slots__ = ("_dirs", "_dir_ids", "_source_dirs", "_source_names", "_target_dirs", "_target_names")
+
+    def __init__(self, pairs=()):
+        self._dirs = []
+        self._dir_ids = {}
+        self._source_dirs = array("l")
+        self._source_names = []
+        self._target_dirs = array("l")
+        self._target_names = []
+        self.extend(pairs)
+
+    def append(self, pair):
+        source_dir, source_name = self._split(str(pair[0]))
+        target_dir, target_name = self._split(str(pair[1]))
+        if target_name == source_name:
+            target_name = source_name
+        elif self._target_names and target_name == self._target_names[-1]:
+            target_name = self._target_names[-1]
+        self._source_dirs.append(source_dir)
+        self._source_names.append(source_name)
+        self._target_dirs.append(target_dir)
+        self._target_names.append(target_name)
+
+    def extend(self, pairs):
+        if isinstance(pairs, CompactMap):
+            pairs = pairs.iter_names()
+        for pair in pairs:
+            self.append(pair)
+
+    def iter_names(self):
+        """ Iterate over the (source, target) pairs as strings, without creating Path instances. """
+        dirs = self._dirs
+        for i in range(len(self._source_names)):
+            yield (dirs[self._source_dirs[i]] + self._source_names[i],
+                dirs[self._target_dirs[i]] + self._target_names[i])
+
+    def _split(self, name):
+        """ Return the directory index and the file name of name. """
+        pos = name.rfind(os.sep) + 1
+        directory = name[:pos]
+        dir_id = self._dir_ids.get(directory)
+        if dir_id is None:
+            dir_id = len(self._dirs)
+            self._dirs.append(directory)
+            self._dir_ids[directory] = dir_id
+        return dir_id, name[pos:]
+
+    def __len__(self):
+        return len(self._source_names)
+
+    def __iter__(self):
+        for source, target in self.iter_names():
+            yield pathlib.Path(source), pathlib.Path(target)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("CompactMap index out of range")
+        dirs = self._dirs
+        return (pathlib.Path(dirs[self._source_dirs[index]] + self._source_names[index]),
+            pathlib.Path(dirs[self._target_dirs[index]] + self._target_names[index]))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "CompactMap({!r})".format(list(self))
+
+def _iter_names(file_map):
+    """ Iterate over the (source, target) pairs of file_map as strings. """
+    if isinstance(file_map, CompactMap):
+        return file_map.iter_names()
+    return ((str(s), str(t)) for s, t in file_map)
+
+def _source_key(src):
+    """ Return a key that is equal for src globs that produce the same files. """
+    if isinstance(src, LazyGlob):
+        return (str(src.path), src.pattern, id(src.walker))
+    return id(src)
+
+def _function_of(method):
+    return getattr(method, "__func__", method)
+
+def _overrides_regex_hooks(mapper_class):
+    """ Check if mapper_class overrides the matching or target methods of RegexMapper. """
+    return (_function_of(mapper_class._source_matches) is not _function_of(RegexMapper._source_matches)
+        or _function_of(mapper_class._get_target_from_source) is not _function_of(RegexMapper._get_target_from_source))
+
+class PatternDispatcher(object):
+    """
+    Create the maps of several RegexMappers in a single pass over their sources.
+
+    GlobMapper patterns (prefix*suffix) are looked up in tables that are
+    keyed by the suffix, so a file name is only compared with the glob
+    patterns that end like it. The other patterns are tried one after the
+    other. The file name string is only created once per source.
+    """
+    def __init__(self, mappers):
+        self.mappers = mappers
+        self.suffix_tables = {}
+        self.regex_mappers = []
+        for i, mapper in enumerate(mappers):
+            glob_parts = getattr(mapper, "glob_parts", None)
+            if glob_parts is not None and mapper.ignore_nonmatching and mapper.flags == 0:
+                prefix, suffix = glob_parts
+                table = self.suffix_tables.setdefault(len(suffix), {})
+                table.setdefault(suffix, []).append((i, prefix, len(prefix) + len(suffix) + 1))
+            else:
+                self.regex_mappers.append(i)
+        self.suffix_tables = sorted(self.suffix_tables.items())
+
+    @staticmethod
+    def can_dispatch(mapper):
+        """ Check if the map of mapper can be created by a PatternDispatcher. """
+        mapper_class = type(mapper)
+        return (isinstance(mapper, RegexMapper)
+            and _function_of(mapper_class._create_map) is _function_of(RegexMapper._create_map)
+            and _function_of(mapper_class._get_target_name) is _function_of(RegexMapper._get_target_name)
+            and not _overrides_regex_hooks(mapper_class))
+
+    def create_maps(self, src):
+        """ Return a list with the map of each mapper, in the order of the mappers. """
+        maps = [m._new_map() for m in self.mappers]
+        for source in src:
+            name = str(source)
+            for i, target_name in self._match(name):
+                maps[i].append((source, pathlib.Path(target_name)))
+        return maps
+
+    def _match(self, name):
+        """ Return the (mapper index, target name) tuples for name, ordered by mapper index. """
+        matches = []
+        if "\n" in name:
+            # Newlines behave differently with regular expressions, so don't
+            # use the glob tables.
+            candidates = range(len(self.mappers))
+        else:
+            candidates = list(self.regex_mappers)
+            length = len(name)
+            for suffix_length, table in self.suffix_tables:
+                if suffix_length > length:
+                    break
+                for i, prefix, min_length in table.get(name[length - suffix_length:], ()):
+                    if length >= min_length and name.startswith(prefix):
+                        candidates.append(i)
+            candidates.sort()
+        for i in candidates:
+            target_name = self.mappers[i]._get_target_name(name)
+            if target_name is not None:
+                matches.append((i, target_name))
+        return matches
+
 class ChainedMapper(BaseFileMapper):
-    def __init__(self, src="*", sub_mappers=[], callback=None, **kwargs):
+    def __init__(self, src="*", sub_mappers=[], callback=None, fused=False, pipelined=False, **kwargs):
+        if fused and pipelined:
+            raise RuntimeError("A ChainedMapper can't be fused and pipelined.")
         super(ChainedMapper, self).__init__(src, callback, **kwargs)
         self.sub_mappers = sub_mappers
+        self.fused = fused
+        self.pipelined = pipelined
 
     def _create_map(self, src):
-        start_source = None
+        """
+        Follow each source file of the first sub-mapper through all sub-mappers.
+
+        Return the map of the sources of the first sub-mapper to the targets
+        of the last sub-mapper. The targets of each sub-mapper are joined with
+        the sources of the next sub-mapper by their name, so files that are
+        filtered out by a sub-mapper are dropped from the map and merged files
+        keep all their original sources.
+
+        The complete path of each file through the sub-mappers is stored in
+        `self.chains`.
+        """
+        chains = None
         for m in self.sub_mappers:
             m.src = src
             file_map = m.get_map()
             if not file_map:
+                self.chains = []
                 if self.allow_empty_map:
-                    return self._get_task_for_empty_map(task)
+                    return self._new_map()
                 else:
                     raise RuntimeError("The generated map is empty. Please check your mapper parameters.")
-            sources, targets = zip(*file_map)
-            src = list(set([str(t) for t in targets]))
-            if start_source == None:
-                start_source = sources
-        return zip(start_source, targets)
+            if chains is None:
+                chains = [(source, target) for source, target in file_map]
+            else:
+                chains = self._join_chains(chains, m, file_map)
+            src = list(OrderedDict((str(c[-1]), True) for c in chains))
+        self.chains = chains
+        file_map = self._new_map()
+        seen = set()
+        for chain in chains:
+            key = (str(chain[0]), str(chain[-1]))
+            if key not in seen:
+                seen.add(key)
+                file_map.append((chain[0], chain[-1]))
+        return file_map
+
+    def _join_chains(self, chains, mapper, file_map):
+        """ Extend each chain with the targets that mapper created for the last file of the chain. """
+        targets_by_source = defaultdict(list)
+        for source, target in file_map:
+            targets_by_source[str(source)].append(target)
+        if isinstance(mapper, BaseFileMapper):
+            in_path = mapper.in_path
+            source_name = lambda name: str(in_path / name)
+        else:
+            source_name = lambda name: name
+        return [chain + (target,)
+            for chain in chains
+            for target in targets_by_source.get(source_name(str(chain[-1])), ())]
 
     def get_task(self, task={}):
-        if self.callback == None:
+        if self.callback == None and self.pipelined:
+            yield self._get_pipelined_task(task)
+        elif self.callback == None and not self.fused:
             src = self.src
             self.map_counters = defaultdict(lambda: 0)
             for mapper in self.sub_mappers:
@@ -262,15 +1216,662 @@ class ChainedMapper(BaseFileMapper):
                 yield sub_task
         else:
             task = super(ChainedMapper, self).get_task(task)
-            task["name"] = "chained_map"
+            task["name"] = "fused_chain" if self.callback == None else "chained_map"
             yield task
 
+    def get_tasks(self, task={}, shard_size=1, by_directory=False):
+        """ Yield sub-tasks like get_task, with each stage split into sub-tasks like BaseFileMapper.get_tasks. """
+        if self.callback == None and self.pipelined:
+            yield self._get_pipelined_task(task)
+        elif self.callback == None and not self.fused:
+            src = self.src
+            self.map_counters = defaultdict(lambda: 0)
+            for mapper in self.sub_mappers:
+                mapper.src = src
+                stage_name = self._get_taskname(mapper, task)
+                for sub_task in mapper.get_tasks(task, shard_size, by_directory):
+                    sub_task["name"] = "{}/{}".format(stage_name, sub_task["name"])
+                    yield sub_task
+                src = list(OrderedDict.fromkeys(t for s, t in _iter_names(mapper.get_map())))
+        else:
+            for sub_task in super(ChainedMapper, self).get_tasks(task, shard_size, by_directory):
+                yield sub_task
+
+    def _get_pipelined_task(self, task):
+        """ Return a single task that runs the callbacks of all sub-mappers with a PipelinedChain. """
+        file_map = self.get_map()
+        if not file_map:
+            task = self._get_task_for_empty_map(self._get_task_data(task))
+        else:
+            task = self._get_task_data(task)
+            targets = OrderedDict()
+            for mapper in self.sub_mappers:
+                for source, target in _iter_names(mapper.get_map()):
+                    targets[target] = True
+            task["targets"] = list(targets)
+            task["actions"] = [PipelinedChain(self.sub_mappers, self.workers)]
+            if self.file_dep:
+                task["file_dep"] = list(OrderedDict.fromkeys(s for s, t in _iter_names(self.sub_mappers[0].get_map())))
+        task["name"] = "pipelined_chain"
+        return task
+
+    def _get_callback(self, task):
+        if self.callback == None and self.fused:
+            return FusedChainCallback(self.sub_mappers, self.chains)
+        return super(ChainedMapper, self)._get_callback(task)
+
     def _get_taskname(self, mapper, task):
         classname = type(mapper).__name__
         self.map_counters[classname] += 1
         suffix = self.map_counters[classname]
         return "{}{}".format(classname, suffix)
 
+class FusedChainCallback(object):
+    """
+    Run the callbacks of all sub-mappers of a chain for one file, passing the
+    intermediate data in memory.
+
+    The callbacks of the sub-mappers must be decorated with `open_files` or
+    `open_files_with_merge`. The source file is opened for the first
+    callback and the target file for the last callback, all other callbacks
+    read from and write to in-memory buffers. The intermediate files are
+    never written.
+    """
+    def __init__(self, sub_mappers, chains):
+        self.stages = []
+        for mapper in sub_mappers:
+            file_callback = getattr(mapper.callback, "file_callback", None)
+            if file_callback is None:
+                raise RuntimeError("Can't fuse callback of {}, it must be decorated with open_files or open_files_with_merge.".format(
+                    type(mapper).__name__))
+            self.stages.append((file_callback, mapper.callback.file_modes))
+        self.cache_fingerprint = "fused:" + "|".join(callback_fingerprint(m.callback) for m in sub_mappers)
+        self.chains = {}
+        origins = {}
+        for chain in chains:
+            self.chains.setdefault((str(chain[0]), str(chain[-1])), chain)
+            for intermediate in chain[1:-1]:
+                origin = origins.setdefault(str(intermediate), str(chain[0]))
+                if origin != str(chain[0]):
+                    raise RuntimeError("Can't fuse chain, {} is created from more than one source file.".format(intermediate))
+        self.opened = set()
+
+    def __call__(self, source, target):
+        chain = self.chains[(str(source), str(target))]
+        data = None
+        last = len(self.stages) - 1
+        for i, (func, (in_mode, out_mode, out_append_mode)) in enumerate(self.stages):
+            if i == 0:
+                in_handle = source.open(in_mode)
+            else:
+                in_handle = _memory_file(data, in_mode)
+            if i < last:
+                out_handle = io.BytesIO() if "b" in out_mode else io.StringIO()
+            else:
+                target_name = str(target)
+                if out_append_mode and target_name in self.opened:
+                    out_mode = out_append_mode
+                self.opened.add(target_name)
+                out_handle = target.open(out_mode)
+            try:
+                ok = func(in_handle, out_handle)
+                if i < last:
+                    data = out_handle.getvalue()
+            finally:
+                in_handle.close()
+                out_handle.close()
+            if ok == False:
+                return False
+        return ok
+
+class PipelinedChain(object):
+    """
+    Action that runs the callbacks of all sub-mappers of a chain, moving
+    each file to the next stage as soon as it is finished.
+
+    Each stage has its own worker threads and a bounded work queue. The
+    work items are the pairs of one target. An item of the next stage is
+    queued when all of its source files have been created by the previous
+    stage. If an item fails, the items that depend on its target are
+    skipped. An unhandled exception stops all stages.
+    """
+    def __init__(self, sub_mappers, workers=None):
+        self.sub_mappers = sub_mappers
+        self.workers = workers
+        self.callbacks = [self._get_stage_callback(m) for m in sub_mappers]
+        self.groups = []
+        self.countdowns = []
+        self.consumers = []
+        for k, mapper in enumerate(sub_mappers):
+            groups = OrderedDict((str(pairs[0][1]), pairs) for pairs in _group_by_target(mapper.get_map()))
+            self.groups.append(groups)
+            self.countdowns.append(OrderedDict((key, 0) for key in groups))
+            self.consumers.append(defaultdict(list))
+            if k > 0:
+                self._link_stages(k)
+
+    def _link_stages(self, k):
+        """ Record which items of stage k wait for the targets of stage k-1. """
+        mapper = self.sub_mappers[k]
+        produced_by = {}
+        for key in self.groups[k - 1]:
+            name = str(mapper.in_path / key) if isinstance(mapper, BaseFileMapper) else key
+            produced_by[name] = key
+        for key, pairs in self.groups[k].items():
+            for source_name in set(str(s) for s, t in pairs):
+                if source_name in produced_by:
+                    self.consumers[k - 1][produced_by[source_name]].append(key)
+                    self.countdowns[k][key] += 1
+
+    def _get_stage_callback(self, mapper):
+        callback = mapper.callback
+        if callback and not hasattr(callback, "__call__"):
+            if "%(sources)s" in callback or "%(targets)s" in callback:
+                raise RuntimeError("Pipelined chains can't run batch commands.")
+            return CommandCallback(callback)
+        return callback
+
+    def __call__(self, targets):
+        self.events = queue.Queue()
+        self.abort = threading.Event()
+        queues = []
+        threads = []
+        for k, mapper in enumerate(self.sub_mappers):
+            workers = getattr(mapper, "workers", None) or self.workers or multiprocessing.cpu_count()
+            queues.append(queue.Queue(2 * workers))
+            for i in range(workers):
+                thread = threading.Thread(target=self._work, args=(k, queues[k]))
+                thread.daemon = True
+                thread.start()
+                threads.append((k, thread))
+        ready = [deque(key for key, count in self.countdowns[k].items() if count == 0) for k in range(len(self.sub_mappers))]
+        countdowns = [dict(c) for c in self.countdowns]
+        outstanding = sum(len(groups) for groups in self.groups)
+        ok = True
+        try:
+            while outstanding > 0:
+                self._dispatch(queues, ready)
+                event = self.events.get()
+                if event[0] == "abort":
+                    raise event[1]
+                k, key, results = event
+                outstanding -= 1
+                failed = False
+                for source, target, value, error, seconds in results:
+                    if error is not None:
+                        value = self.sub_mappers[k].error_handling[1](error)
+                    if value == False or error is not None:
+                        failed = True
+                    ok = _ok_value(value, ok)
+                if failed:
+                    outstanding -= self._skip_consumers(k, key, countdowns)
+                    continue
+                for consumer in self.consumers[k][key]:
+                    if countdowns[k + 1][consumer] is None:
+                        continue
+                    countdowns[k + 1][consumer] -= 1
+                    if countdowns[k + 1][consumer] == 0:
+                        ready[k + 1].append(consumer)
+        finally:
+            self.abort.set()
+            for k, thread in threads:
+                queues[k].put(None)
+            for k, thread in threads:
+                thread.join()
+            for callback in self.callbacks:
+                close = getattr(callback, "close", None)
+                if close is not None:
+                    close()
+        return ok
+
+    def _dispatch(self, queues, ready):
+        """ Move ready items into the stage queues until they are full, later stages first. """
+        for k in reversed(range(len(queues))):
+            while ready[k]:
+                key = ready[k][0]
+                try:
+                    queues[k].put_nowait((key, self.groups[k][key]))
+                except queue.Full:
+                    break
+                ready[k].popleft()
+
+    def _skip_consumers(self, k, key, countdowns):
+        """ Skip all items that depend on the target key of stage k. Return the number of skipped items. """
+        skipped = 0
+        todo = [(k, key)]
+        while todo:
+            k, key = todo.pop()
+            for consumer in self.consumers[k][key]:
+                if countdowns[k + 1][consumer] is not None:
+                    countdowns[k + 1][consumer] = None
+                    skipped += 1
+                    todo.append((k + 1, consumer))
+        return skipped
+
+    def _work(self, k, work_queue):
+        callback = self.callbacks[k]
+        handled_exceptions = self.sub_mappers[k].error_handling[0]
+        while True:
+            item = work_queue.get()
+            if item is None:
+                return
+            if self.abort.is_set():
+                continue
+            key, pairs = item
+            try:
+                self.events.put((k, key, _call_pairs(callback, handled_exceptions, pairs)))
+            except Exception as e:
+                self.abort.set()
+                self.events.put(("abort", e))
+
+class CommandCallback(object):
+    """ Callback that runs a command with `%(source)s` and `%(target)s` placeholders in a shell. """
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.cache_fingerprint = "command:" + cmd
+
+    def __call__(self, source, target):
+        command, status = _run_command(self.cmd % {"source": source, "target": target})
+        if status != 0:
+            sys.stderr.write("Command failed with exit status {}: {}\n".format(status, command))
+        return status == 0
+
+def _memory_file(data, mode):
+    """ Return an in-memory file object for reading data in mode. """
+    if "b" in mode:
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        return io.BytesIO(data)
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    return io.StringIO(data)
+
+
+def _ok_value(v, ok):
+    if v == False or ok == False:
+        return False
+    else:
+        return True
+
+def _group_by_target(file_map):
+    """ Return a list of pair lists, one for each target, in map order. """
+    groups = OrderedDict()
+    for source, target in file_map:
+        groups.setdefault(str(target), []).append((source, target))
+    return list(groups.values())
+
+def _partition_from_environment():
+    """ Return the (index, count) partition from the FILEMAPPER_PARTITION_INDEX and FILEMAPPER_PARTITION_COUNT environment variables. """
+    try:
+        return (int(os.environ.get("FILEMAPPER_PARTITION_INDEX", 0)),
+            int(os.environ.get("FILEMAPPER_PARTITION_COUNT", 1)))
+    except ValueError:
+        raise RuntimeError("FILEMAPPER_PARTITION_INDEX and FILEMAPPER_PARTITION_COUNT must be integers.")
+
+def _pack_balanced(items, sizes, bin_count, capacity=None):
+    """
+    Distribute items over bin_count bins so that the sum of their sizes is similar.
+
+    Uses the longest processing time heuristic: the items are assigned
+    from the largest to the smallest to the bin with the smallest total.
+    A bin gets at most capacity items. Returns the non-empty bins as lists,
+    the bin with the largest total first.
+    """
+    bins = [[] for i in range(max(bin_count, 1))]
+    heap = [(0, i) for i in range(len(bins))]
+    full = []
+    for i in sorted(range(len(items)), key=lambda i: -sizes[i]):
+        total, b = heapq.heappop(heap)
+        bins[b].append(items[i])
+        if capacity is not None and len(bins[b]) >= capacity:
+            full.append((total + sizes[i], b))
+        else:
+            heapq.heappush(heap, (total + sizes[i], b))
+        if not heap:
+            # All bins are full, allow them to grow beyond capacity
+            heap, full = full, []
+            heapq.heapify(heap)
+    totals = dict((b, total) for total, b in heap + full)
+    order = sorted(range(len(bins)), key=lambda b: -totals[b])
+    return [bins[b] for b in order if bins[b]]
+
+def _split_map(file_map, shard_size=1, by_directory=False):
+    """ Split file_map into (name, pairs) shards, keeping the pairs of a target together. """
+    groups = _group_by_target(file_map)
+    if by_directory:
+        shards = OrderedDict()
+        for pairs in groups:
+            directory = os.path.dirname(str(pairs[0][1])) or "."
+            shards.setdefault(directory, []).extend(pairs)
+        return list(shards.items())
+    if shard_size <= 1:
+        return [(str(pairs[0][1]), pairs) for pairs in groups]
+    shards = []
+    shard = []
+    for pairs in groups:
+        shard.extend(pairs)
+        if len(shard) >= shard_size:
+            shards.append(("shard{}".format(len(shards) + 1), shard))
+            shard = []
+    if shard:
+        shards.append(("shard{}".format(len(shards) + 1), shard))
+    return shards
+
+class PairStats(object):
+    """ Statistics for calling the callback with one source/target pair. """
+    __slots__ = ("source", "target", "seconds", "bytes_read", "bytes_written", "ok", "error")
+    fields = __slots__
+
+    def __init__(self, source, target, seconds, bytes_read, bytes_written, ok, error):
+        self.source = source
+        self.target = target
+        self.seconds = seconds
+        self.bytes_read = bytes_read
+        self.bytes_written = bytes_written
+        self.ok = ok
+        self.error = error
+
+    def as_dict(self):
+        return dict((field, getattr(self, field)) for field in self.fields)
+
+class ActionStats(object):
+    """
+    Collect statistics while the action of a mapper runs.
+
+    Calls the `on_start` and `on_finish` hooks of the mapper and writes the
+    optional stats report.
+    """
+    def __init__(self, mapper):
+        self.mapper_name = type(mapper).__name__
+        self.map_build_seconds = mapper.map_build_time
+        self.on_start = mapper.on_start
+        self.on_finish = mapper.on_finish
+        self.collect_pairs = bool(mapper.stats_report)
+        self.pairs = []
+        self.pair_count = 0
+        self.error_count = 0
+        self.failed_count = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.target_sizes = {}
+        self.unhandled_error = None
+        self.start = default_timer()
+        self.execution_seconds = None
+
+    def announce(self, file_map):
+        """ Call the on_start hook for each pair when the pair is handed to the executor. """
+        for source, target in file_map:
+            if self.on_start:
+                self.on_start(source, target)
+            yield source, target
+
+    def add(self, source, target, value, error, seconds):
+        """
+        Record the result of a pair.
+
+        The byte counts are file sizes, not I/O counts: the size of the
+        source and the growth of the target since the previous pair of the
+        same target, so merged targets are not counted once per source.
+        """
+        target_size = _file_size(target)
+        bytes_written = target_size
+        if target_size is not None:
+            target_name = str(target)
+            bytes_written = max(target_size - self.target_sizes.get(target_name, 0), 0)
+            self.target_sizes[target_name] = target_size
+        pair = PairStats(str(source), str(target), seconds, _file_size(source), bytes_written,
+            error is None and value != False, _error_name(error) if error is not None else None)
+        self.pair_count += 1
+        self.bytes_read += pair.bytes_read or 0
+        self.bytes_written += pair.bytes_written or 0
+        if error is not None:
+            self.error_count += 1
+        elif value == False:
+            self.failed_count += 1
+        if self.collect_pairs:
+            self.pairs.append(pair)
+        if self.on_finish:
+            self.on_finish(source, target, pair)
+
+    def finish(self):
+        self.execution_seconds = default_timer() - self.start
+
+    def as_dict(self):
+        return {
+            "mapper": self.mapper_name,
+            "map_build_seconds": self.map_build_seconds,
+            "execution_seconds": self.execution_seconds,
+            "pairs": self.pair_count,
+            "errors": self.error_count,
+            "failed": self.failed_count,
+            "unhandled_error": self.unhandled_error,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "pair_stats": [p.as_dict() for p in self.pairs],
+        }
+
+    def write_report(self, path, targets):
+        """
+        Merge the statistics into the report at path, as CSV if the file name ends with `.csv`, otherwise as JSON.
+
+        The entries of targets (the targets of the action) are replaced and
+        the entries of other targets are kept, so the sub-tasks of
+        `get_tasks` can share one report.
+        """
+        path = str(path)
+        pairs = [p.as_dict() for p in self.pairs]
+        def merge_pairs(old_pairs):
+            return [p for p in old_pairs if p["target"] not in targets] + pairs
+        if path.endswith(".csv"):
+            _update_file(path, merge_pairs, _read_csv, _write_csv, [])
+        else:
+            _update_json(path, lambda data: self._merge_report(data, merge_pairs(data.get("pair_stats", []))))
+
+    def _merge_report(self, data, pair_stats):
+        """ Return the JSON report for pair_stats, adding the totals of data if it has entries of other targets. """
+        report = self.as_dict()
+        report["pair_stats"] = pair_stats
+        report["pairs"] = len(pair_stats)
+        report["errors"] = sum(1 for p in pair_stats if p["error"] is not None)
+        report["failed"] = sum(1 for p in pair_stats if not p["ok"] and p["error"] is None)
+        report["bytes_read"] = sum(p["bytes_read"] or 0 for p in pair_stats)
+        report["bytes_written"] = sum(p["bytes_written"] or 0 for p in pair_stats)
+        if len(pair_stats) > len(self.pairs):
+            report["execution_seconds"] += data.get("execution_seconds") or 0
+            if report["unhandled_error"] is None:
+                report["unhandled_error"] = data.get("unhandled_error")
+        return report
+
+def _file_size(path):
+    try:
+        return os.path.getsize(str(path))
+    except OSError:
+        return None
+
+def _error_name(error):
+    return "{}: {}".format(type(error).__name__, error)
+
+def _failure_entry(source, target, error):
+    """ Return the failure manifest entry for a pair. Unhandled errors have no pair. """
+    return {
+        "source": str(source) if source is not None else None,
+        "target": str(target) if target is not None else None,
+        "error": _error_name(error) if error is not None else "Callback returned False",
+    }
+
+def _is_async_callback(callback):
+    """ Check if callback is a coroutine function or marked as returning awaitables. """
+    if getattr(callback, "async_callback", False) is True:
+        return True
+    return asyncio is not None and asyncio.iscoroutinefunction(callback)
+
+def _start_coroutine(loop, callback, pair):
+    """ Call callback and return a future for its result. """
+    try:
+        return asyncio.ensure_future(callback(*pair), loop=loop)
+    except Exception as e:
+        future = loop.create_future()
+        future.set_exception(e)
+        return future
+
+def _command_line_limit():
+    """ Return the maximum length of a shell command, leaving room for the environment. """
+    try:
+        arg_max = os.sysconf("SC_ARG_MAX")
+    except (AttributeError, ValueError, OSError):
+        arg_max = MAX_ARG_STRLEN
+    environment_size = sum(len(k) + len(v) + 2 for k, v in os.environ.items())
+    return max(min(arg_max - environment_size - 2048, MAX_ARG_STRLEN - 1), 4096)
+
+def _render_batch_command(cmd, sources, targets):
+    targets = list(targets)
+    return cmd % {"sources": " ".join(sources), "targets": " ".join(targets), "target": targets[0]}
+
+def _run_command(command):
+    return command, subprocess.call(command, shell=True)
+
+def _is_fresh_by_mtime(pairs):
+    """ Check if the common target of pairs is newer than all sources. """
+    try:
+        target_mtime = os.stat(str(pairs[0][1])).st_mtime
+        return all(os.stat(str(s)).st_mtime <= target_mtime for s, t in pairs)
+    except OSError:
+        return False
+
+def file_digest(path, block_size=1024 * 1024):
+    """ Return the SHA-1 hex digest of the contents of path. """
+    digest = hashlib.sha1()
+    try:
+        with open(str(path), "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                digest.update(block)
+    except IOError:
+        return None
+    return digest.hexdigest()
+
+def _write_json(path, data):
+    """ Write data as JSON to path, replacing the file atomically. """
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.rename(tmp_path, path)
+
+def _read_csv(f):
+    return list(csv.DictReader(f))
+
+def _write_csv(path, rows):
+    """ Write the PairStats rows as CSV to path, replacing the file atomically. """
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        writer = csv.DictWriter(f, PairStats.fields)
+        writer.writeheader()
+        writer.writerows(rows)
+    os.rename(tmp_path, path)
+
+_json_lock = threading.Lock()
+
+def _update_json(path, update):
+    """
+    Pass the data of the JSON file path (or an empty dictionary) to update and write the result.
+
+    If update returns None, the file is deleted. An exclusive lock on
+    `path.lock` is held during the update, so actions running in parallel
+    (e.g. with `doit -n`) don't lose each other's changes. The lock file
+    is left in place: removing it while another process waits for the lock
+    would let a third process lock a new file with the same name.
+    """
+    _update_file(path, update, json.load, _write_json, {})
+
+def _update_file(path, update, read, write, empty):
+    """ Like _update_json, with the functions to read and write the file and the data of a missing file. """
+    with _json_lock:
+        lock_file = open(path + ".lock", "a") if fcntl is not None else None
+        try:
+            if lock_file is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                with open(path) as f:
+                    data = read(f)
+            except (IOError, ValueError):
+                data = empty
+            data = update(data)
+            if data is not None:
+                write(path, data)
+            elif os.path.exists(path):
+                os.remove(path)
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+
+class HashState(object):
+    """
+    On-disk record of the source digests that were used to build each target.
+
+    The state file is a JSON object that maps target names to a dictionary
+    of source names and their digests.
+    """
+    def __init__(self, path):
+        self.path = str(path)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def update(self, digests):
+        """ Merge digests into the state file, keeping the entries of other targets. """
+        if not digests:
+            return
+        def update(state):
+            state.update(digests)
+            return state
+        _update_json(self.path, update)
+
+def _call_pairs(callback, handled_exceptions, pairs):
+    """ Call callback for each pair, returning handled exceptions instead of raising them. """
+    results = []
+    try:
+        for source, target in pairs:
+            start = default_timer()
+            try:
+                results.append((source, target, callback(source, target), None, default_timer() - start))
+            except handled_exceptions as e:
+                results.append((source, target, None, e, default_timer() - start))
+    finally:
+        # All pairs of a target are in one work item, so its file can be closed now
+        close = getattr(callback, "close", None)
+        if close is not None:
+            for target in OrderedDict((str(t), t) for s, t in pairs).values():
+                close(target)
+    return results
+
+def _fork_context():
+    """
+    Return the multiprocessing context that forks its worker processes.
+
+    The process execution mode always forks, regardless of the default start
+    method, because callbacks are not pickled. Python 2 always forks on POSIX.
+    """
+    if hasattr(multiprocessing, "get_context"):
+        try:
+            return multiprocessing.get_context("fork")
+        except ValueError:
+            pass
+    elif sys.platform != "win32":
+        return multiprocessing
+    raise RuntimeError("The process execution mode needs the fork start method, which is not available on this platform.")
+
+_worker_context = {}
+
+def _init_worker(callback, handled_exceptions):
+    _worker_context["callback"] = callback
+    _worker_context["handled_exceptions"] = handled_exceptions
+
+def _call_pairs_in_worker(pairs):
+    return _call_pairs(_worker_context["callback"], _worker_context["handled_exceptions"], pairs)
+
 
 def open_files(func, in_mode="r", out_mode="w"):
     """ Open files for callback """
@@ -278,31 +1879,313 @@ def open_files(func, in_mode="r", out_mode="w"):
         with _in.open(in_mode) as in_handle, _out.open(out_mode) as out_handle:
             ok = func(in_handle, out_handle, *args, **kwargs)
         return ok
+    file_opener.file_callback = func
+    file_opener.file_modes = (in_mode, out_mode, None)
     return file_opener
 
-def track_file_count(func):
-    # See http://stackoverflow.com/questions/3190706/nonlocal-keyword-in-python-2-x
-    # to learn why this must be a dictionary
-    call_count = {"count":0}
-    def file_tracker(_in, _out, *args, **kwargs):
-        ok = func(_in, _out, file_count=call_count["count"], *args, **kwargs)
-        call_count["count"] += 1
+def open_files_mmap(func, out_mode="wb"):
+    """
+    Map the source file into memory for callback. The callback gets a
+    read-only mmap object instead of a file handle, empty files are passed
+    as an empty byte string.
+    """
+    def file_opener(_in, _out, *args, **kwargs):
+        with open(str(_in), "rb") as in_handle, _out.open(out_mode) as out_handle:
+            if os.fstat(in_handle.fileno()).st_size == 0:
+                return func(b"", out_handle, *args, **kwargs)
+            data = mmap.mmap(in_handle.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                ok = func(data, out_handle, *args, **kwargs)
+            finally:
+                data.close()
         return ok
-    return file_tracker
+    return file_opener
 
-def open_files_with_merge(func, in_mode="r", out_mode="w", out_append_mode="a"):
-    opened = {}
+# Errors that mean the kernel can't copy between these two files, not that the copy failed
+_COPY_FALLBACK_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EBADF, errno.ENOTSUP, errno.EOPNOTSUPP)
+
+def _copy_in_kernel(copy, in_fd, out_fd, size):
+    """ Copy size bytes with copy(in_fd, out_fd, offset, count). Return False if copy is not supported for the files. """
+    offset = 0
+    while offset < size:
+        try:
+            copied = copy(in_fd, out_fd, offset, min(size - offset, 1024 * 1024 * 1024))
+        except OSError as e:
+            if offset == 0 and e.errno in _COPY_FALLBACK_ERRORS:
+                return False
+            raise
+        if copied == 0:
+            break
+        offset += copied
+    return True
+
+_libc_functions = {}
+
+def _libc_sendfile():
+    """ Return a copy function that calls sendfile of the C library (for Python 2, which has no os.sendfile) or None. """
+    if "sendfile" not in _libc_functions:
+        try:
+            import ctypes
+            sendfile = ctypes.CDLL(None, use_errno=True).sendfile64
+        except (ImportError, OSError, AttributeError):
+            _libc_functions["sendfile"] = None
+            return None
+        sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+        sendfile.restype = ctypes.c_ssize_t
+        def copy(in_fd, out_fd, offset, count):
+            position = ctypes.c_int64(offset)
+            copied = sendfile(out_fd, in_fd, ctypes.byref(position), count)
+            if copied < 0:
+                error = ctypes.get_errno()
+                raise OSError(error, os.strerror(error))
+            return copied
+        _libc_functions["sendfile"] = copy
+    return _libc_functions["sendfile"]
+
+def _kernel_copy_functions():
+    functions = []
+    if hasattr(os, "copy_file_range"):
+        functions.append(lambda in_fd, out_fd, offset, count: os.copy_file_range(in_fd, out_fd, count, offset, offset))
+    if sys.platform.startswith("linux"):
+        if hasattr(os, "sendfile"):
+            functions.append(lambda in_fd, out_fd, offset, count: os.sendfile(out_fd, in_fd, offset, count))
+        elif _libc_sendfile() is not None:
+            functions.append(_libc_sendfile())
+    return functions
+
+def fast_copy(_in, _out):
+    """
+    Copy the source file to the target file and copy the permission bits.
+
+    The data is copied by the kernel with copy_file_range or sendfile where
+    available, without passing through user space. On Linux with Python 2,
+    sendfile of the C library is called with ctypes. Falls back to
+    shutil.copyfileobj for other platforms and file systems.
+    """
+    with open(str(_in), "rb") as in_handle, open(str(_out), "wb") as out_handle:
+        in_fd, out_fd = in_handle.fileno(), out_handle.fileno()
+        size = os.fstat(in_fd).st_size
+        # Pseudo files report a size of 0, only shutil reads them correctly
+        for copy in _kernel_copy_functions() if size else []:
+            if _copy_in_kernel(copy, in_fd, out_fd, size):
+                break
+        else:
+            shutil.copyfileobj(in_handle, out_handle, 1024 * 1024)
+    shutil.copymode(str(_in), str(_out))
+    return True
+
+def open_files_async(func, in_mode="r", out_mode="w"):
+    """ Open files for a coroutine callback. The files are closed when the coroutine has finished. """
     def file_opener(_in, _out, *args, **kwargs):
-        out_name = str(_out)
-        if out_name in opened:
-            o_mode = out_append_mode
-            opened[out_name] += 1
+        in_handle = _in.open(in_mode)
+        try:
+            out_handle = _out.open(out_mode)
+            try:
+                future = asyncio.ensure_future(func(in_handle, out_handle, *args, **kwargs))
+            except Exception:
+                out_handle.close()
+                raise
+        except Exception:
+            in_handle.close()
+            raise
+        def close_files(f):
+            in_handle.close()
+            out_handle.close()
+        future.add_done_callback(close_files)
+        return future
+    file_opener.async_callback = True
+    return file_opener
+
+def track_file_count(func):
+    # The counter is a plain integer until the action starts a process
+    # pool, which calls share_between_processes before forking the workers.
+    counter = {"value": 0, "shared": None}
+    lock = threading.Lock()
+    def file_tracker(_in, _out, *args, **kwargs):
+        shared = counter["shared"]
+        if shared is not None:
+            with shared.get_lock():
+                file_count = shared.value
+                shared.value += 1
         else:
-            o_mode = out_mode
-            opened[out_name] = 1
-        with _in.open(in_mode) as in_handle, _out.open(o_mode) as out_handle:
-            ok = func(in_handle, out_handle, *args, **kwargs)
-        return ok
+            with lock:
+                file_count = counter["value"]
+                counter["value"] += 1
+        return func(_in, _out, file_count=file_count, *args, **kwargs)
+    def share_between_processes():
+        """ Move the counter to shared memory, so forked workers count together. """
+        with lock:
+            if counter["shared"] is None:
+                counter["shared"] = _fork_context().Value("l", counter["value"])
+    file_tracker.share_between_processes = share_between_processes
+    return file_tracker
+
+def _share_between_processes(callback, depth=0):
+    """ Call share_between_processes of callback and of the callbacks it wraps (e.g. with open_files). """
+    share = getattr(callback, "share_between_processes", None)
+    if share is not None:
+        share()
+    if depth >= MAX_WRAPPER_DEPTH:
+        return
+    wrapped = [getattr(callback, "callback", None)]
+    for cell in getattr(callback, "__closure__", None) or ():
+        try:
+            wrapped.append(cell.cell_contents)
+        except ValueError:
+            continue
+    for function in wrapped:
+        if hasattr(function, "__call__"):
+            _share_between_processes(function, depth + 1)
+
+class HandlePool(object):
+    """
+    Keep target files of a merging callback open between calls.
+
+    At most max_open files are open at the same time, the least recently
+    used file that is not in use is closed when another file must be opened.
+    Files that were opened before are reopened with out_append_mode.
+    """
+    def __init__(self, max_open, out_mode="w", out_append_mode="a", buffer_size=-1):
+        self.max_open = max_open
+        self.out_mode = out_mode
+        self.out_append_mode = out_append_mode
+        self.buffer_size = buffer_size
+        self.handles = OrderedDict()
+        self.in_use = defaultdict(lambda: 0)
+        self.opened = set()
+        self.lock = threading.Lock()
+
+    def acquire(self, path):
+        """ Return the open handle for path, opening it if necessary. """
+        name = str(path)
+        with self.lock:
+            handle = self.handles.pop(name, None)
+            if handle is None:
+                self._evict(self.max_open - 1)
+                mode = self.out_append_mode if name in self.opened else self.out_mode
+                handle = path.open(mode, self.buffer_size)
+                self.opened.add(name)
+            self.handles[name] = handle
+            self.in_use[name] += 1
+        return handle
+
+    def release(self, path):
+        with self.lock:
+            name = str(path)
+            self.in_use[name] -= 1
+            if self.in_use[name] == 0:
+                del self.in_use[name]
+
+    def close(self, path=None):
+        """ Flush and close the handle of path or all handles that are not in use. """
+        with self.lock:
+            if path is None:
+                self._evict(0)
+                return
+            name = str(path)
+            if name in self.handles and name not in self.in_use:
+                self.handles.pop(name).close()
+
+    def _evict(self, size):
+        for name in list(self.handles):
+            if len(self.handles) <= size:
+                break
+            if name not in self.in_use:
+                self.handles.pop(name).close()
+
+def open_files_with_merge(func, in_mode="r", out_mode="w", out_append_mode="a", max_open=None, buffer_size=None):
+    """
+    Open files for callback, opening targets that were opened before in append mode.
+
+    If max_open is set, up to max_open target files are kept open between
+    calls. Call the `close` attribute of the returned function to flush and
+    close them, the actions of the mappers do this when they finish.
+    """
+    if max_open is not None:
+        pool = HandlePool(max_open, out_mode, out_append_mode, buffer_size or MERGE_BUFFER_SIZE)
+        def file_opener(_in, _out, *args, **kwargs):
+            out_handle = pool.acquire(_out)
+            try:
+                with _in.open(in_mode) as in_handle:
+                    ok = func(in_handle, out_handle, *args, **kwargs)
+            finally:
+                pool.release(_out)
+            return ok
+        file_opener.close = pool.close
+    else:
+        opened = {}
+        open_args = (buffer_size,) if buffer_size else ()
+        def file_opener(_in, _out, *args, **kwargs):
+            out_name = str(_out)
+            if out_name in opened:
+                o_mode = out_append_mode
+                opened[out_name] += 1
+            else:
+                o_mode = out_mode
+                opened[out_name] = 1
+            with _in.open(in_mode) as in_handle, _out.open(o_mode, *open_args) as out_handle:
+                ok = func(in_handle, out_handle, *args, **kwargs)
+            return ok
+    file_opener.file_callback = func
+    file_opener.file_modes = (in_mode, out_mode, out_append_mode)
     return file_opener
 
+def _read_chunks(handle, chunk_size):
+    return iter(partial(handle.read, chunk_size), b"")
+
+def stream_records(func, record="line", batch_size=1000, chunk_size=64 * 1024, merge=False, max_open=None):
+    """
+    Turn func, a function that transforms one record, into a callback that
+    streams the records of the source file to the target file.
+
+    record can be `line` (func gets and returns strings with line breaks),
+    `csv` (func gets and returns rows as lists) or `chunk` (func gets and
+    returns byte strings of chunk_size bytes). Records for which func
+    returns None are dropped. The results are written in batches of
+    batch_size records. If merge is true, the files are opened like in
+    open_files_with_merge. Additional arguments of the callback (e.g. the
+    file_count of track_file_count) are passed to func with each record.
+    """
+    if record not in RECORD_TYPES:
+        raise RuntimeError("record must be one of {}.".format(", ".join(RECORD_TYPES)))
+    def stream(in_handle, out_handle, *args, **kwargs):
+        if record == "csv" and sys.version_info[0] >= 3:
+            # The csv module of Python 3 needs text files opened with newline=""
+            in_text = io.TextIOWrapper(in_handle, newline="")
+            out_text = io.TextIOWrapper(out_handle, newline="")
+            try:
+                return stream_handles(in_text, out_text, *args, **kwargs)
+            finally:
+                out_text.flush()
+                # Leave the binary handles open for the file opener
+                in_text.detach()
+                out_text.detach()
+        return stream_handles(in_handle, out_handle, *args, **kwargs)
+    def stream_handles(in_handle, out_handle, *args, **kwargs):
+        if record == "csv":
+            records, write = csv.reader(in_handle), csv.writer(out_handle).writerows
+        elif record == "chunk":
+            records, write = _read_chunks(in_handle, chunk_size), out_handle.writelines
+        else:
+            records, write = in_handle, out_handle.writelines
+        batch = []
+        for r in records:
+            result = func(r, *args, **kwargs)
+            if result is not None:
+                batch.append(result)
+            if len(batch) >= batch_size:
+                write(batch)
+                batch = []
+        if batch:
+            write(batch)
+        return True
+    if record in ("csv", "chunk"):
+        in_mode, out_mode = "rb", "wb"
+    else:
+        in_mode, out_mode = "r", "w"
+    if merge:
+        out_append_mode = out_mode.replace("w", "a")
+        return open_files_with_merge(stream, in_mode, out_mode, out_append_mode, max_open)
+    return open_files(stream, in_mode, out_mode)
+
 # TODO  and open_files_for_merge decorators
\ No newline at end of file
@@ -0,0 +1,337 @@
+"""
+File discovery for mappers, based on os.scandir.
+
+The FileWalker can replace pathlib.Path.glob when evaluating the `src` glob
+of a mapper. It prunes directories that can't contain matches and excluded
+directories (like `.git` or `node_modules`) before reading them and uses the
+file type information of the directory entries instead of calling stat.
+"""
+import fnmatch
+import os
+import re
+import threading
+import pathlib
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+FILE_TYPES = ("file", "dir", "any")
+
+class _ListdirEntry(object):
+    """ Minimal replacement for os.DirEntry if scandir is not available. """
+    __slots__ = ("name", "path")
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+
+    def is_dir(self, follow_symlinks=True):
+        if not follow_symlinks and os.path.islink(self.path):
+            return False
+        return os.path.isdir(self.path)
+
+    def is_file(self, follow_symlinks=True):
+        if not follow_symlinks and os.path.islink(self.path):
+            return False
+        return os.path.isfile(self.path)
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks:
+            return os.stat(self.path)
+        return os.lstat(self.path)
+
+def list_entries(directory):
+    """ Return a list of directory entries for directory. """
+    if scandir is not None:
+        return list(scandir(directory))
+    return [_ListdirEntry(directory, name) for name in os.listdir(directory)]
+
+def _translate_segment(segment):
+    """ Translate a glob expression for a single path segment into a regular expression. """
+    i, n = 0, len(segment)
+    regex = ""
+    while i < n:
+        c = segment[i]
+        i += 1
+        if c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "[":
+            j = i
+            if j < n and segment[j] == "!":
+                j += 1
+            if j < n and segment[j] == "]":
+                j += 1
+            while j < n and segment[j] != "]":
+                j += 1
+            if j >= n:
+                regex += "\\["
+            else:
+                chars = segment[i:j].replace("\\", "\\\\")
+                i = j + 1
+                if chars[0] == "!":
+                    chars = "^" + chars[1:]
+                elif chars[0] == "^":
+                    chars = "\\" + chars
+                regex += "[" + chars + "]"
+        else:
+            regex += re.escape(c)
+    return regex + r"\Z"
+
+class GlobMatcher(object):
+    """
+    Match relative paths against a glob pattern segment by segment.
+
+    The matcher is a small NFA over the pattern segments: a state is the
+    index of the next segment that must be matched. This makes it possible
+    to decide for a directory if any path below it can match.
+    """
+    def __init__(self, pattern):
+        self.raw_segments = [s for s in pattern.split("/") if s not in ("", ".")]
+        self.segments = []
+        for segment in self.raw_segments:
+            if segment == "**":
+                self.segments.append(None)
+            else:
+                self.segments.append(re.compile(_translate_segment(segment)))
+        self.accept = len(self.segments)
+
+    def start(self):
+        """ Return the states for the directory where the glob starts. """
+        return self._closure(set([0]))
+
+    def literal_prefix(self):
+        """ Return the leading directory names that contain no wildcards. """
+        prefix = []
+        for segment in self.raw_segments[:-1]:
+            if segment == "**" or any(c in segment for c in "*?["):
+                break
+            prefix.append(segment)
+        return prefix
+
+    def match(self, rel_path):
+        """ Check if the relative path (with `/` separators) matches the pattern. """
+        states = self.start()
+        for name in rel_path.split("/"):
+            states = self.advance(states, name)
+            if not states:
+                return False
+        return self.matches(states)
+
+    def advance(self, states, name):
+        """ Return the states after consuming the path segment name. """
+        next_states = set()
+        for i in states:
+            if i == self.accept:
+                continue
+            segment = self.segments[i]
+            if segment is None:
+                next_states.add(i)
+            elif segment.match(name):
+                next_states.add(i + 1)
+        return self._closure(next_states)
+
+    def matches(self, states):
+        return self.accept in states
+
+    def can_descend(self, states):
+        return any(i < self.accept for i in states)
+
+    def _closure(self, states):
+        todo = list(states)
+        while todo:
+            i = todo.pop()
+            if i < self.accept and self.segments[i] is None and i + 1 not in states:
+                states.add(i + 1)
+                todo.append(i + 1)
+        return states
+
+class FileWalker(object):
+    """
+    Find files below a directory that match a glob pattern, using os.scandir.
+
+    Parameters:
+    - exclude: Glob patterns for file and directory names that are skipped.
+      Excluded directories are not read at all. Patterns with a `/` are
+      matched against the path relative to the search directory.
+    - max_depth: Maximum number of directory levels below the search
+      directory. None means no limit.
+    - file_type: Return only `file` entries (the default), only `dir`
+      entries or `any` entries.
+    - follow_symlinks: Descend into symbolic links to directories.
+    - index: DirectoryIndex that caches the directory listings.
+    - collect_sizes: Store the size of each found file in the `sizes`
+      dictionary (path name -> size), so it does not have to be read again.
+    """
+    def __init__(self, exclude=(), max_depth=None, file_type="file", follow_symlinks=False, index=None, collect_sizes=False):
+        if file_type not in FILE_TYPES:
+            raise RuntimeError("file_type must be one of {}.".format(", ".join(FILE_TYPES)))
+        self.exclude = list(exclude)
+        self.max_depth = max_depth
+        self.file_type = file_type
+        self.follow_symlinks = follow_symlinks
+        self.index = index
+        self.collect_sizes = collect_sizes
+        self.sizes = {}
+
+    def with_index(self, index):
+        """ Return a copy of this walker that reads directory listings from index. The copy shares the `sizes`. """
+        walker = FileWalker(self.exclude, self.max_depth, self.file_type, self.follow_symlinks, index, self.collect_sizes)
+        walker.sizes = self.sizes
+        return walker
+
+    def glob(self, path, pattern):
+        """ Yield Path instances for the entries below path that match the glob pattern. """
+        matcher = GlobMatcher(pattern)
+        states = matcher.start()
+        prefix = matcher.literal_prefix()
+        for name in prefix:
+            states = matcher.advance(states, name)
+        if self.max_depth is not None and len(prefix) > self.max_depth:
+            # The files below the literal directories are already too deep
+            return
+        start = os.path.join(str(path), *prefix) if prefix else str(path)
+        for entry in self._walk(matcher, start, "/".join(prefix), states, len(prefix)):
+            path = pathlib.Path(entry.path)
+            if self.collect_sizes and entry.is_file():
+                # Uses the stat result of the directory listing where the platform provides it
+                self.sizes[str(path)] = entry.stat().st_size
+            yield path
+
+    def _walk(self, matcher, directory, rel_dir, states, depth):
+        try:
+            entries = self._list_entries(directory)
+        except OSError:
+            return
+        subdirs = []
+        for entry in entries:
+            rel_path = rel_dir + "/" + entry.name if rel_dir else entry.name
+            if self._is_excluded(entry.name, rel_path):
+                continue
+            entry_states = matcher.advance(states, entry.name)
+            if not entry_states:
+                continue
+            is_dir = entry.is_dir(follow_symlinks=self.follow_symlinks)
+            if matcher.matches(entry_states) and self._has_file_type(entry, is_dir):
+                yield entry
+            if is_dir and matcher.can_descend(entry_states) and (self.max_depth is None or depth < self.max_depth):
+                subdirs.append((entry, rel_path, entry_states))
+        for entry, rel_path, entry_states in subdirs:
+            for found in self._walk(matcher, entry.path, rel_path, entry_states, depth + 1):
+                yield found
+
+    def _list_entries(self, directory):
+        if self.index is not None:
+            return self.index.list_entries(directory)
+        return list_entries(directory)
+
+    def _is_excluded(self, name, rel_path):
+        for pattern in self.exclude:
+            if fnmatch.fnmatchcase(rel_path if "/" in pattern else name, pattern):
+                return True
+        return False
+
+    def _has_file_type(self, entry, is_dir):
+        if self.file_type == "any":
+            return True
+        if self.file_type == "dir":
+            return is_dir
+        return not is_dir and entry.is_file()
+
+class _IndexEntry(object):
+    """ Directory entry that was read from the listing cache of a DirectoryIndex. """
+    __slots__ = ("name", "path", "_flags")
+
+    def __init__(self, directory, name, flags):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._flags = flags
+
+    def is_dir(self, follow_symlinks=True):
+        is_symlink, is_dir, is_file = self._flags
+        return is_dir and (follow_symlinks or not is_symlink)
+
+    def is_file(self, follow_symlinks=True):
+        is_symlink, is_dir, is_file = self._flags
+        return is_file and (follow_symlinks or not is_symlink)
+
+    def is_symlink(self):
+        return self._flags[0]
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks:
+            return os.stat(self.path)
+        return os.lstat(self.path)
+
+class DirectoryIndex(object):
+    """
+    Cache of directory listings that can be shared by all mappers of a process.
+
+    Each directory is read once. The cached listing is used until the
+    modification time of the directory changes, i.e. until files are
+    created, deleted or renamed in it. Any number of glob and regex queries
+    can be answered from the cached listings.
+    """
+    def __init__(self):
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def list_entries(self, directory):
+        """ Return the entries of directory, reading it only if it has changed. """
+        key = os.path.abspath(directory)
+        mtime = os.stat(directory).st_mtime
+        with self._lock:
+            cached = self._listings.get(key)
+        if cached is None or cached[0] != mtime:
+            listing = []
+            for entry in list_entries(directory):
+                is_symlink = entry.is_symlink()
+                listing.append((entry.name, (is_symlink, entry.is_dir(), entry.is_file())))
+            cached = (mtime, listing)
+            with self._lock:
+                self._listings[key] = cached
+        return [_IndexEntry(directory, name, flags) for name, flags in cached[1]]
+
+    def invalidate(self, directory=None):
+        """ Drop the cached listing of directory or of all directories. """
+        with self._lock:
+            if directory is None:
+                self._listings.clear()
+            else:
+                self._listings.pop(os.path.abspath(str(directory)), None)
+
+    def glob(self, path, pattern, walker=None):
+        """ Yield Path instances for the files below path that match the glob pattern. """
+        walker = (walker or FileWalker()).with_index(self)
+        return walker.glob(path, pattern)
+
+    def search(self, path, regex, walker=None):
+        """
+        Yield Path instances for the files below path whose relative path matches regex.
+
+        regex can be a string or a compiled regular expression, it is
+        applied with `search` to the relative path with `/` separators.
+        """
+        if isinstance(regex, basestring):
+            regex = re.compile(regex)
+        root = str(path)
+        for found in self.glob(path, "**/*", walker):
+            rel_path = os.path.relpath(str(found), root).replace(os.sep, "/")
+            if regex.search(rel_path):
+                yield found
+
+shared_index = DirectoryIndex()
@@ -0,0 +1,398 @@
+"""
+Watch mode for mappers, based on the Linux inotify API.
+
+A MapperWatcher keeps the map of a mapper in memory and updates it when
+source files are created, modified, moved or deleted. The callback is only
+called for the source/target pairs that are affected by a change, including
+the following stages of a ChainedMapper. The file system is never rescanned
+unless the kernel reports that events were lost.
+"""
+import ctypes
+import ctypes.util
+import os
+import pathlib
+import select
+import struct
+import subprocess
+import sys
+from collections import defaultdict, OrderedDict
+
+from .filemappers import ChainedMapper, CompositeMapper, LazyGlob
+from .walker import FileWalker, GlobMatcher, list_entries
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+# struct inotify_event: int wd; uint32_t mask, cookie, len; char name[]
+EVENT_HEADER = struct.Struct("iIII")
+
+def _encode_path(path):
+    if isinstance(path, bytes):
+        return path
+    return path.encode(sys.getfilesystemencoding())
+
+def _decode_name(name):
+    if str is bytes:
+        return name
+    return name.decode(sys.getfilesystemencoding(), "surrogateescape")
+
+class Inotify(object):
+    """ Minimal binding of the Linux inotify API with ctypes. """
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise RuntimeError("Watch mode needs inotify, which is only available on Linux.")
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        try:
+            init = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+        except AttributeError:
+            raise RuntimeError("The C library does not support inotify.")
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = init(IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise_error()
+
+    def _raise_error(self):
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """ Watch the directory path and return the watch descriptor. """
+        wd = self._add_watch(self.fd, _encode_path(path), mask)
+        if wd < 0:
+            self._raise_error()
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """
+        Wait up to timeout seconds for events and return them as a list of
+        (wd, mask, cookie, name) tuples. All events that are available are
+        returned at once.
+        """
+        events = []
+        ready = select.select([self.fd], [], [], timeout)[0]
+        while ready:
+            data = os.read(self.fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                events.append((wd, mask, cookie, _decode_name(name)))
+            ready = select.select([self.fd], [], [], 0)[0]
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+class _StageState(object):
+    """ The pairs of one mapper, indexed by source and target name. """
+    def __init__(self, mapper, pairs):
+        self.mapper = mapper
+        self.pairs = OrderedDict()
+        self.targets_of = defaultdict(list)
+        self.sources_of = OrderedDict()
+        for source, target in pairs:
+            self._add(source, target)
+
+    def _add(self, source, target):
+        key = (str(source), str(target))
+        if key in self.pairs:
+            return
+        self.pairs[key] = (source, target)
+        self.targets_of[key[0]].append(key[1])
+        self.sources_of.setdefault(key[1], []).append(key[0])
+
+    def _remove_source(self, source_name):
+        targets = self.targets_of.pop(source_name, [])
+        for target_name in targets:
+            del self.pairs[(source_name, target_name)]
+            self.sources_of[target_name].remove(source_name)
+            if not self.sources_of[target_name]:
+                del self.sources_of[target_name]
+        return targets
+
+    def sources_below(self, directory):
+        prefix = os.path.join(directory, "")
+        return [name for name in self.targets_of if name.startswith(prefix)]
+
+    def update(self, changed, removed):
+        """
+        Update the pairs for the changed and removed source files.
+
+        changed is a list of Path instances, removed a list of names.
+        Return the pairs of all affected targets (including all sources of
+        merged targets) and the names of the targets that have no sources left.
+        """
+        affected = OrderedDict()
+        for source_name in list(removed) + [str(p) for p in changed]:
+            for target_name in self._remove_source(source_name):
+                affected[target_name] = True
+        if changed:
+            # A ChainedMapper raises an error if none of the changed files passes all sub-mappers
+            allow_empty_map = self.mapper.allow_empty_map
+            self.mapper.allow_empty_map = True
+            try:
+                new_pairs = self.mapper._create_map(changed)
+            finally:
+                self.mapper.allow_empty_map = allow_empty_map
+            for source, target in new_pairs:
+                self._add(source, target)
+                affected[str(target)] = True
+        run_pairs = []
+        orphaned = []
+        for target_name in affected:
+            if target_name in self.sources_of:
+                run_pairs.extend(self.pairs[(s, target_name)] for s in self.sources_of[target_name])
+            else:
+                orphaned.append(target_name)
+        return run_pairs, orphaned
+
+class MapperWatcher(object):
+    """
+    Process the files of a mapper when they change.
+
+    The `src` of the mapper must be a glob. Directories below `in_path`
+    that can contain matching files are watched with inotify. If the glob
+    uses a FileWalker, its `exclude`, `max_depth` and `follow_symlinks`
+    settings apply to the watched directories and files. For a
+    ChainedMapper without callback, the targets that are created by one
+    sub-mapper are passed on to the next sub-mapper.
+
+    Parameters:
+    - mapper: The mapper to watch.
+    - delete_targets: Delete targets when all of their source files were deleted.
+    """
+    def __init__(self, mapper, delete_targets=False):
+        if isinstance(mapper, CompositeMapper):
+            raise RuntimeError("A CompositeMapper can't be watched, watch its sub-mappers instead.")
+        if not isinstance(mapper.src, LazyGlob):
+            raise RuntimeError("Watch mode needs a mapper with a glob expression as src.")
+        self.mapper = mapper
+        self.delete_targets = delete_targets
+        self.root = str(mapper.src.path)
+        self.matcher = GlobMatcher(mapper.src.pattern)
+        self.walker = mapper.src.walker if isinstance(mapper.src.walker, FileWalker) else None
+        if self.walker is not None and self.walker.file_type == "dir":
+            raise RuntimeError("Watch mode needs a walker that finds files.")
+        if isinstance(mapper, ChainedMapper) and mapper.callback is None and not mapper.fused:
+            self.stages = list(mapper.sub_mappers)
+        else:
+            self.stages = [mapper]
+        self.inotify = None
+        self.watches = {}
+        self.states = []
+        self.ok = True
+
+    def start(self):
+        """ Build the map and start watching the source directories. """
+        self._load_states()
+        self.inotify = Inotify()
+        self._add_watches(self.root, "")
+
+    def _load_states(self):
+        self.mapper.map_initialized = False
+        file_map = self.mapper.get_map()
+        if len(self.stages) == 1:
+            self.states = [_StageState(self.mapper, file_map)]
+        else:
+            self.states = [_StageState(m, m.get_map()) for m in self.stages]
+
+    def _add_watches(self, directory, rel_dir):
+        """ Watch directory and its subdirectories that can contain sources. Return the matching files in them. """
+        try:
+            wd = self.inotify.add_watch(directory)
+            entries = list_entries(directory)
+        except OSError:
+            return []
+        self.watches[wd] = (directory, rel_dir)
+        found = []
+        follow_symlinks = self.walker is not None and self.walker.follow_symlinks
+        for entry in entries:
+            rel_path = rel_dir + "/" + entry.name if rel_dir else entry.name
+            if entry.is_dir(follow_symlinks=follow_symlinks):
+                if self._can_contain(rel_path):
+                    found.extend(self._add_watches(entry.path, rel_path))
+            elif entry.is_file() and self._is_source(rel_path):
+                found.append(str(pathlib.Path(entry.path)))
+        return found
+
+    def _remove_watches(self, directory):
+        prefix = os.path.join(directory, "")
+        for wd, (watched, rel_dir) in list(self.watches.items()):
+            if watched == directory or watched.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+
+    def _can_contain(self, rel_dir):
+        """ Check if files below the relative directory can match the src glob. """
+        names = rel_dir.split("/")
+        if self.walker is not None:
+            if self.walker._is_excluded(names[-1], rel_dir):
+                return False
+            if self.walker.max_depth is not None and len(names) > self.walker.max_depth:
+                return False
+        states = self.matcher.start()
+        for name in names:
+            states = self.matcher.advance(states, name)
+            if not states:
+                return False
+        return self.matcher.can_descend(states)
+
+    def _is_source(self, rel_path):
+        """ Check if the file with the relative path is a source, the directories above it were already checked. """
+        names = rel_path.split("/")
+        if self.walker is not None:
+            if self.walker._is_excluded(names[-1], rel_path):
+                return False
+            if self.walker.max_depth is not None and len(names) - 1 > self.walker.max_depth:
+                return False
+        return self.matcher.match(rel_path)
+
+    def poll(self, timeout=None):
+        """
+        Wait up to timeout seconds for changes and process them.
+
+        Return the list of source/target pairs that were processed. The
+        `ok` attribute is False if a callback of this poll returned False.
+        """
+        if self.inotify is None:
+            self.start()
+        changed = OrderedDict()
+        removed = OrderedDict()
+        for wd, mask, cookie, name in self.inotify.read(timeout):
+            if mask & IN_Q_OVERFLOW:
+                return self._rescan()
+            if wd not in self.watches:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+            directory, rel_dir = self.watches[wd]
+            if not name:
+                continue
+            path = os.path.join(directory, name)
+            rel_path = rel_dir + "/" + name if rel_dir else name
+            is_dir = mask & IN_ISDIR
+            if not is_dir and mask & (IN_CREATE | IN_MOVED_TO) and self.walker is not None and self.walker.follow_symlinks:
+                is_dir = os.path.isdir(path)
+            if is_dir:
+                if mask & (IN_CREATE | IN_MOVED_TO) and self._can_contain(rel_path):
+                    for found in self._add_watches(path, rel_path):
+                        changed[found] = True
+                        removed.pop(found, None)
+                elif mask & IN_MOVED_FROM:
+                    self._remove_watches(path)
+                    for source_name in self.states[0].sources_below(str(pathlib.Path(path))):
+                        removed[source_name] = True
+                        changed.pop(source_name, None)
+                continue
+            if not self._is_source(rel_path):
+                continue
+            source_name = str(pathlib.Path(path))
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                changed[source_name] = True
+                removed.pop(source_name, None)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                removed[source_name] = True
+                changed.pop(source_name, None)
+        if not changed and not removed:
+            return []
+        return self._process([pathlib.Path(p) for p in changed], list(removed))
+
+    def _process(self, changed, removed):
+        """ Update the map of each stage and run the callbacks for the affected pairs. """
+        processed = []
+        self.ok = True
+        for k, state in enumerate(self.states):
+            run_pairs, orphaned = state.update(changed, removed)
+            if self.delete_targets:
+                for target_name in orphaned:
+                    if os.path.lexists(target_name):
+                        os.remove(target_name)
+            if run_pairs:
+                self.ok = self._run(state.mapper, run_pairs) != False and self.ok
+                processed.extend(run_pairs)
+            if k + 1 < len(self.states):
+                next_mapper = self.stages[k + 1]
+                targets = OrderedDict((str(t), True) for s, t in run_pairs)
+                changed = [next_mapper.in_path / t for t in targets]
+                removed = [str(next_mapper.in_path / t) for t in orphaned]
+        if len(self.states) == 1:
+            file_map = self.mapper._new_map()
+            file_map.extend(self.states[0].pairs.values())
+            self.mapper.map = file_map
+        return processed
+
+    def _run(self, mapper, pairs):
+        """ Run the callback of mapper for pairs. Targets are deleted first, so merged targets are created from scratch. """
+        for target_name in OrderedDict((str(t), True) for s, t in pairs):
+            if os.path.lexists(target_name):
+                os.remove(target_name)
+        if isinstance(mapper, ChainedMapper):
+            # Sets the chains of the sources for a fused callback
+            mapper._create_map(list(OrderedDict((str(s), s) for s, t in pairs).values()))
+        callback = mapper._get_callback(mapper.task)
+        if hasattr(callback, "__call__"):
+            return mapper.get_action(callback, pairs)([])
+        ok = True
+        if callback:
+            for action in mapper.get_cmd_action(callback, pairs):
+                if hasattr(action, "__call__"):
+                    ok = action([]) != False and ok
+                else:
+                    ok = subprocess.call(action, shell=True) == 0 and ok
+        return ok
+
+    def _rescan(self):
+        """ Rebuild the map after lost events and run the callbacks for all stale pairs. """
+        self._load_states()
+        self._add_watches(self.root, "")
+        processed = []
+        self.ok = True
+        for state in self.states:
+            stale = state.mapper.get_stale_map()
+            if stale:
+                self.ok = self._run(state.mapper, stale) != False and self.ok
+                processed.extend(stale)
+        return processed
+
+    def watch(self, timeout=1.0, stop=None):
+        """
+        Process changes until stop (a threading.Event) is set or the
+        process is interrupted with Ctrl-C.
+        """
+        if self.inotify is None:
+            self.start()
+        try:
+            while stop is None or not stop.is_set():
+                self.poll(timeout)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        """ Stop watching. """
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+            self.watches = {}
@@ -4,9 +4,6 @@ import shutil
 def rename_file(_in, _out):
     shutil.move(str(_in), str(_out))
 
-def copy_file(_in, _out):
-    shutil.copy(str(_in), str(_out))
-
 def task_create_build_dir():
     return {
         "actions": ["mkdir build"],
@@ -17,7 +14,7 @@ def task_create_build_dir():
 def task_convert_files():
     sub_mappers = [
         # Copy files
-        fm.GlobMapper("*", copy_file, "build/*.txt", "src/*.txt"),
+        fm.GlobMapper("*", fm.fast_copy, "build/*.txt", "src/*.txt"),
         # Rename lingering file
         fm.RegexMapper("*", rename_file, search="foo.txt", replace="foo3.txt", dir="build", file_dep=False),
     ]
@@ -0,0 +1,136 @@
+import doitfilemappers.filemappers as fm
+from doitfilemappers.cache import OutputCache, CachedCallback, callback_fingerprint
+
+import mock
+import os
+import pathlib
+import pytest
+
+def create_checkout(tmpdir, name, files):
+    checkout = tmpdir.mkdir(name)
+    for file_name, content in files.items():
+        checkout.join(file_name).write(content)
+    return checkout
+
+def upper(_in, _out):
+    _out.write(_in.read().upper())
+
+def lower(_in, _out):
+    _out.write(_in.read().lower())
+
+def test_fingerprint_depends_on_function_code():
+    assert callback_fingerprint(upper) == callback_fingerprint(upper)
+    assert callback_fingerprint(upper) != callback_fingerprint(lower)
+
+def test_fingerprint_of_decorated_callback_depends_on_decorated_function():
+    assert callback_fingerprint(fm.open_files(upper)) == callback_fingerprint(fm.open_files(upper))
+    assert callback_fingerprint(fm.open_files(upper)) != callback_fingerprint(fm.open_files(lower))
+    assert callback_fingerprint(fm.open_files(upper)) != callback_fingerprint(fm.open_files(upper, out_mode="a"))
+
+def test_fingerprint_of_command_is_the_command():
+    assert callback_fingerprint(fm.CommandCallback("cp %(source)s %(target)s")) == "command:cp %(source)s %(target)s"
+
+def test_cache_restores_stored_file(tmpdir):
+    cache = OutputCache(str(tmpdir.join("cache")))
+    tmpdir.join("source").write("data")
+    tmpdir.join("target").write("result")
+    key = cache.key(str(tmpdir.join("source")), "fingerprint")
+    assert not cache.restore(key, str(tmpdir.join("restored")))
+    cache.store(key, str(tmpdir.join("target")))
+    assert cache.restore(key, str(tmpdir.join("restored")))
+    assert tmpdir.join("restored").read() == "result"
+    assert key != cache.key(str(tmpdir.join("source")), "other fingerprint")
+
+def test_cache_restores_hard_links(tmpdir):
+    cache = OutputCache(str(tmpdir.join("cache")), restore="link")
+    tmpdir.join("target").write("result")
+    cache.store("abcdef", str(tmpdir.join("target")))
+    assert cache.restore("abcdef", str(tmpdir.join("restored")))
+    assert os.path.samefile(str(tmpdir.join("restored")), str(tmpdir.join("cache", "ab", "abcdef")))
+
+def test_cache_treats_entry_evicted_during_restore_as_miss(tmpdir):
+    cache = OutputCache(str(tmpdir.join("cache")))
+    tmpdir.join("target").write("result")
+    cache.store("abcdef", str(tmpdir.join("target")))
+    with mock.patch("doitfilemappers.cache.shutil.copyfile", side_effect=IOError(2, "No such file")):
+        assert not cache.restore("abcdef", str(tmpdir.join("restored")))
+    assert not tmpdir.join("restored").exists()
+
+def test_cache_rejects_unknown_restore_mode(tmpdir):
+    with pytest.raises(RuntimeError):
+        OutputCache(str(tmpdir), restore="move")
+
+def test_cache_evicts_least_recently_used_files(tmpdir):
+    cache = OutputCache(str(tmpdir.join("cache")), max_size=10)
+    tmpdir.join("target").write("123456")
+    cache.store("aa1", str(tmpdir.join("target")))
+    os.utime(str(tmpdir.join("cache", "aa", "aa1")), (1000, 1000))
+    cache.store("bb1", str(tmpdir.join("target")))
+    assert not tmpdir.join("cache", "aa", "aa1").exists()
+    assert tmpdir.join("cache", "bb", "bb1").exists()
+
+def test_mapper_restores_targets_from_cache_in_other_checkout(tmpdir):
+    cache = OutputCache(str(tmpdir.join("cache")))
+    calls = []
+    @fm.open_files
+    def callback(_in, _out):
+        calls.append(_in)
+        upper(_in, _out)
+    for name in ["one", "two"]:
+        checkout = create_checkout(tmpdir, name, {"a.txt": "a", "b.txt": "b"})
+        mapper = fm.GlobMapper(["a.txt", "b.txt"], callback, "*.out", "*.txt", in_path=str(checkout), cache=cache)
+        assert mapper.get_task()["actions"][0](["dummy"])
+        assert checkout.join("a.out").read() == "A"
+        assert checkout.join("b.out").read() == "B"
+    assert len(calls) == 2
+
+def test_mapper_caches_command_callbacks(tmpdir):
+    log = tmpdir.join("log")
+    for name in ["one", "two"]:
+        checkout = create_checkout(tmpdir, name, {"a.txt": "a"})
+        mapper = fm.GlobMapper(["a.txt"], "cp %(source)s %(target)s && echo run >> " + str(log), "*.out", "*.txt",
+            in_path=str(checkout), cache=str(tmpdir.join("cache")))
+        actions = mapper.get_task()["actions"]
+        assert actions[0](["dummy"])
+        assert checkout.join("a.out").read() == "a"
+    assert log.read() == "run\n"
+
+def test_mapper_does_not_cache_merged_targets(tmpdir):
+    checkout = create_checkout(tmpdir, "one", {"a.txt": "a", "b.txt": "b"})
+    callback = mock.Mock(return_value=True)
+    mapper = fm.MergeMapper(["a.txt", "b.txt"], callback, target=str(checkout.join("all.out")),
+        in_path=str(checkout), cache=str(tmpdir.join("cache")))
+    action = mapper.get_task()["actions"][0]
+    action(["dummy"])
+    action(["dummy"])
+    assert callback.call_count == 4
+
+def test_cached_callback_does_not_store_failed_targets(tmpdir):
+    cache = OutputCache(str(tmpdir.join("cache")))
+    tmpdir.join("source").write("data")
+    tmpdir.join("target").write("broken")
+    callback = CachedCallback(cache, mock.Mock(return_value=False))
+    assert callback(str(tmpdir.join("source")), str(tmpdir.join("target"))) == False
+    assert not tmpdir.join("cache").exists()
+
+def test_cached_callback_does_not_overwrite_linked_entries(tmpdir):
+    cache = OutputCache(str(tmpdir.join("cache")), restore="link")
+    tmpdir.join("source").write("data")
+    source, target = pathlib.Path(str(tmpdir.join("source"))), pathlib.Path(str(tmpdir.join("target")))
+    to_upper = CachedCallback(cache, fm.open_files(upper))
+    to_lower = CachedCallback(cache, fm.open_files(lower))
+    to_upper(source, target)
+    to_upper(source, target)
+    to_lower(source, target)
+    to_upper(source, target)
+    assert tmpdir.join("target").read() == "DATA"
+    assert to_upper.hits == 2
+
+def test_mapper_stores_flushed_targets_of_pooled_callbacks(tmpdir):
+    callback = fm.open_files_with_merge(upper, max_open=4)
+    for name in ["one", "two"]:
+        checkout = create_checkout(tmpdir, name, {"a.txt": "a"})
+        mapper = fm.GlobMapper(["a.txt"], callback, "*.out", "*.txt", in_path=str(checkout),
+            cache=str(tmpdir.join("cache")))
+        assert mapper.get_task()["actions"][0](["dummy"])
+        assert checkout.join("a.out").read() == "A"
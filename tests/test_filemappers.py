@@ -2,12 +2,20 @@ import doitfilemappers.filemappers as fm
 
 import mock
 import pytest
+import io
+import json
+import multiprocessing
+import os
 import pathlib
+import re
+import shutil
+import sys
+import threading
 
 def get_path_open_mock(name=""):
     p = mock.MagicMock(spec=pathlib.Path)
     p.__str__.return_value = name
-    p_file = mock.MagicMock(spec=file)
+    p_file = mock.MagicMock(spec=io.IOBase)
     p.open.return_value = p_file
     return p
 
@@ -16,13 +24,23 @@ def get_path_open_mock(name=""):
 @mock.patch('doitfilemappers.filemappers.pathlib.Path.glob')
 def test_identitymapper_expands_glob_in_src(mock_glob):
     mapper = fm.IdentityMapper("*.foo")
+    mapper.get_map()
     mock_glob.assert_called_with("*.foo")
 
+@mock.patch('doitfilemappers.filemappers.pathlib.Path.glob')
+def test_identitymapper_defers_glob_until_map_is_needed(mock_glob):
+    p1 = pathlib.Path("one.foo")
+    mock_glob.return_value = iter([p1])
+    mapper = fm.IdentityMapper("*.foo")
+    assert not mock_glob.called
+    assert mapper.get_map() == [(p1, p1)]
+    assert mock_glob.call_count == 1
+
 def test_identitymapper_get_task_fails_if_map_is_empty():
     mapper = fm.IdentityMapper("*.foo")
     with pytest.raises(RuntimeError) as e:
         mapper.get_task()
-    assert "empty" in e.value.message
+    assert "empty" in str(e.value)
 
 def test_identitymapper_empty_map_default_action_returns_true():
     mapper = fm.IdentityMapper("*.foo", allow_empty_map=True)
@@ -96,6 +114,251 @@ def test_identitymapper_exceptions_without_handlers_abort_calls():
     expected = [mock.call(p1, p1)]
     assert custom_callback.call_args_list == expected
 
+def test_identitymapper_thread_execution_calls_callback_for_each_target():
+    p1 = pathlib.Path("one.foo")
+    p2 = pathlib.Path("two.foo")
+    custom_callback = mock.Mock(return_value=True)
+    mapper = fm.IdentityMapper([p1, p2], custom_callback, execution="thread", workers=2)
+    a = mapper.get_action(mapper.callback)
+    assert a(["dummy"])
+    assert sorted(custom_callback.call_args_list) == sorted([mock.call(p1, p1), mock.call(p2, p2)])
+
+def test_identitymapper_thread_execution_handles_exceptions_for_each_target():
+    p1 = pathlib.Path("one.foo")
+    p2 = pathlib.Path("two.foo")
+    handler = mock.Mock(return_value=True)
+    custom_callback = mock.Mock(side_effect=RuntimeError("Test exceptions"))
+    mapper = fm.IdentityMapper([p1, p2], custom_callback, execution="thread", error_handling=((RuntimeError), handler))
+    a = mapper.get_action(mapper.callback)
+    assert a(["dummy"])
+    assert custom_callback.call_count == 2
+    assert handler.call_count == 2
+
+def test_identitymapper_process_execution_returns_false_if_one_callback_fails():
+    p1 = pathlib.Path("one.foo")
+    p2 = pathlib.Path("two.foo")
+    mapper = fm.IdentityMapper([p1, p2], lambda s, t: s.name != "two.foo", execution="process", workers=2)
+    a = mapper.get_action(mapper.callback)
+    assert a(["dummy"]) == False
+
+def test_identitymapper_process_execution_raises_unhandled_exceptions():
+    def fail(_in, _out):
+        raise KeyError("Test exceptions")
+    mapper = fm.IdentityMapper([pathlib.Path("one.foo")], fail, execution="process", error_handling=((RuntimeError), lambda e: True))
+    a = mapper.get_action(mapper.callback)
+    with pytest.raises(KeyError):
+        a(["dummy"])
+
+def test_mergemapper_thread_execution_processes_sources_of_a_target_in_order():
+    sources = [pathlib.Path("{}.foo".format(i)) for i in range(20)]
+    custom_callback = mock.Mock(return_value=True)
+    mapper = fm.MergeMapper(sources, custom_callback, target="target.dummy", execution="thread", chunk_size=3)
+    a = mapper.get_action(mapper.callback)
+    assert a(["dummy"])
+    assert [c[0][0] for c in custom_callback.call_args_list] == sources
+
+def test_async_callback_runs_all_pairs_with_bounded_concurrency():
+    asyncio = pytest.importorskip("asyncio")
+    sources = [pathlib.Path("{}.foo".format(i)) for i in range(10)]
+    state = {"running": 0, "max_running": 0}
+    def callback(source, target):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        state["running"] += 1
+        state["max_running"] = max(state["max_running"], state["running"])
+        def finish():
+            state["running"] -= 1
+            future.set_result(source.name != "3.foo")
+        loop.call_later(0.001, finish)
+        return future
+    callback.async_callback = True
+    mapper = fm.IdentityMapper(sources, callback, workers=3)
+    assert mapper.get_action(mapper.callback)(["dummy"]) == False
+    assert state["max_running"] == 3
+
+def test_async_callback_exceptions_can_be_handled():
+    asyncio = pytest.importorskip("asyncio")
+    def callback(source, target):
+        raise RuntimeError("Test exceptions")
+    callback.async_callback = True
+    handler = mock.Mock(return_value=True)
+    mapper = fm.IdentityMapper([pathlib.Path("one.foo"), pathlib.Path("two.foo")], callback,
+        error_handling=((RuntimeError), handler))
+    assert mapper.get_action(mapper.callback)(["dummy"])
+    assert handler.call_count == 2
+
+def test_action_calls_start_and_finish_hooks_for_each_pair(tmpdir):
+    create_files(tmpdir, ["one.foo", "two.foo"])
+    on_start = mock.Mock()
+    finished = []
+    def on_finish(source, target, stats):
+        finished.append(stats)
+    mapper = fm.GlobMapper(["one.foo", "two.foo"], lambda s, t: shutil.copy(str(s), str(t)), "*.bar", "*.foo",
+        in_path=str(tmpdir), on_start=on_start, on_finish=on_finish)
+    assert mapper.get_action(mapper.callback)(["dummy"])
+    assert on_start.call_count == 2
+    assert [os.path.basename(p.source) for p in finished] == ["one.foo", "two.foo"]
+    assert finished[0].bytes_read == len("one.foo")
+    assert finished[0].bytes_written == len("one.foo")
+    assert finished[0].seconds >= 0
+    assert finished[0].ok
+
+def test_action_stats_count_growth_of_merged_targets(tmpdir):
+    create_files(tmpdir, ["one.foo", "two.foo"])
+    finished = []
+    mapper = fm.MergeMapper(["one.foo", "two.foo"], fm.open_files_with_merge(lambda _in, _out: _out.write(_in.read())),
+        target=str(tmpdir.join("all.bar")), in_path=str(tmpdir), on_finish=lambda s, t, stats: finished.append(stats),
+        stats_report=str(tmpdir.join("stats.json")))
+    assert mapper.get_action(mapper.callback)(["dummy"])
+    assert [p.bytes_written for p in finished] == [len("one.foo"), len("two.foo")]
+    assert json.loads(tmpdir.join("stats.json").read())["bytes_written"] == len("one.footwo.foo")
+
+def test_action_writes_json_stats_report(tmpdir):
+    report = tmpdir.join("stats.json")
+    def callback(source, target):
+        if source.name == "two.foo":
+            raise RuntimeError("broken")
+        return source.name != "three.foo"
+    sources = [pathlib.Path(n) for n in ["one.foo", "two.foo", "three.foo"]]
+    mapper = fm.IdentityMapper(sources, callback, error_handling=((RuntimeError), lambda e: True), stats_report=str(report))
+    mapper.get_action(mapper.callback)(["dummy"])
+    data = json.loads(report.read())
+    assert data["mapper"] == "IdentityMapper"
+    assert data["pairs"] == 3
+    assert data["errors"] == 1
+    assert data["failed"] == 1
+    assert data["map_build_seconds"] >= 0
+    assert data["execution_seconds"] >= 0
+    assert [p["error"] for p in data["pair_stats"]] == [None, "RuntimeError: broken", None]
+
+def test_action_writes_csv_stats_report_on_unhandled_errors(tmpdir):
+    report = tmpdir.join("stats.csv")
+    custom_callback = mock.Mock(side_effect=[True, KeyError("missing")])
+    sources = [pathlib.Path(n) for n in ["one.foo", "two.foo"]]
+    mapper = fm.IdentityMapper(sources, custom_callback, error_handling=((RuntimeError), lambda e: True), stats_report=str(report))
+    with pytest.raises(KeyError):
+        mapper.get_action(mapper.callback)(["dummy"])
+    rows = report.read().splitlines()
+    assert rows[0].startswith("source,target,seconds")
+    assert len(rows) == 2
+
+@pytest.mark.parametrize("name", ["stats.json", "stats.csv"])
+def test_sub_tasks_merge_stats_report(tmpdir, name):
+    report = tmpdir.join(name)
+    sources = [pathlib.Path(n) for n in ["one.foo", "two.foo", "three.foo", "four.foo"]]
+    mapper = fm.IdentityMapper(sources, mock.Mock(side_effect=lambda s, t: s.name != "two.foo"), stats_report=str(report))
+    for task in mapper.get_tasks():
+        task["actions"][0](["dummy"])
+    next(mapper.get_tasks())["actions"][0](["dummy"])
+    if name.endswith(".csv"):
+        rows = report.read().splitlines()
+        assert sorted(r.split(",")[0] for r in rows[1:]) == ["four.foo", "one.foo", "three.foo", "two.foo"]
+    else:
+        data = json.loads(report.read())
+        assert data["pairs"] == 4
+        assert data["failed"] == 1
+        assert sorted(p["target"] for p in data["pair_stats"]) == ["four.foo", "one.foo", "three.foo", "two.foo"]
+
+def test_get_action_rejects_unknown_execution_mode():
+    mapper = fm.IdentityMapper([pathlib.Path("one.foo")], execution="cluster")
+    with pytest.raises(RuntimeError) as e:
+        mapper.get_action(mapper.callback)
+    assert "execution" in str(e.value)
+
+def create_files(tmpdir, names, mtime=1000):
+    for name in names:
+        f = tmpdir.join(name)
+        f.write(name)
+        f.setmtime(mtime)
+
+def test_incremental_mtime_action_calls_callback_for_stale_pairs_only(tmpdir):
+    create_files(tmpdir, ["one.foo", "two.foo", "three.foo"], 1000)
+    create_files(tmpdir, ["one.bar"], 2000)
+    create_files(tmpdir, ["two.bar"], 500)
+    custom_callback = mock.Mock(return_value=True)
+    mapper = fm.GlobMapper(["one.foo", "two.foo", "three.foo"], custom_callback, "*.bar", "*.foo",
+        in_path=str(tmpdir), incremental="mtime")
+    a = mapper.get_action(mapper.callback)
+    assert a(["dummy"])
+    assert [c[0][0].name for c in custom_callback.call_args_list] == ["two.foo", "three.foo"]
+
+def test_incremental_hash_action_skips_unchanged_sources(tmpdir):
+    create_files(tmpdir, ["one.foo", "two.foo"])
+    custom_callback = mock.Mock(side_effect=lambda _in, _out: shutil.copy(str(_in), str(_out)))
+    state_file = str(tmpdir.join("state.json"))
+    mapper = fm.GlobMapper(["one.foo", "two.foo"], custom_callback, "*.bar", "*.foo",
+        in_path=str(tmpdir), incremental="hash", state_file=state_file)
+    mapper.get_action(mapper.callback)(["dummy"])
+    assert custom_callback.call_count == 2
+    mapper.get_action(mapper.callback)(["dummy"])
+    assert custom_callback.call_count == 2
+    tmpdir.join("two.foo").write("changed")
+    mapper.get_action(mapper.callback)(["dummy"])
+    assert custom_callback.call_count == 3
+    assert custom_callback.call_args[0][0].name == "two.foo"
+
+def test_incremental_hash_action_does_not_record_failed_targets(tmpdir):
+    create_files(tmpdir, ["one.foo", "one.bar"])
+    custom_callback = mock.Mock(return_value=False)
+    state_file = str(tmpdir.join("state.json"))
+    mapper = fm.GlobMapper(["one.foo"], custom_callback, "*.bar", "*.foo",
+        in_path=str(tmpdir), incremental="hash", state_file=state_file)
+    assert not mapper.get_action(mapper.callback)(["dummy"])
+    assert not mapper.get_action(mapper.callback)(["dummy"])
+    assert custom_callback.call_count == 2
+
+def test_incremental_mergemapper_rebuilds_all_sources_of_stale_target(tmpdir):
+    create_files(tmpdir, ["one.foo", "two.foo"], 1000)
+    create_files(tmpdir, ["target.bar"], 1500)
+    tmpdir.join("two.foo").setmtime(2000)
+    custom_callback = mock.Mock(return_value=True)
+    mapper = fm.MergeMapper(["one.foo", "two.foo"], custom_callback, target=str(tmpdir.join("target.bar")),
+        in_path=str(tmpdir), incremental="mtime")
+    mapper.get_action(mapper.callback)(["dummy"])
+    assert custom_callback.call_count == 2
+
+@pytest.mark.parametrize("mode", ["mtime", "hash"])
+def test_incremental_rejects_sources_that_are_their_own_target(tmpdir, mode):
+    create_files(tmpdir, ["one.foo"])
+    custom_callback = mock.Mock(return_value=True)
+    mapper = fm.IdentityMapper([pathlib.Path(str(tmpdir.join("one.foo")))], custom_callback,
+        incremental=mode, state_file=str(tmpdir.join("state.json")))
+    with pytest.raises(RuntimeError) as e:
+        mapper.get_action(mapper.callback)(["dummy"])
+    assert "incremental" in str(e.value)
+    assert not custom_callback.called
+
+def test_incremental_command_action_runs_commands_for_stale_pairs_only(tmpdir):
+    create_files(tmpdir, ["one.foo", "two.foo"], 1000)
+    create_files(tmpdir, ["one.bar"], 2000)
+    log = tmpdir.join("log")
+    mapper = fm.GlobMapper(["one.foo", "two.foo"], "echo %(source)s >> " + str(log), "*.bar", "*.foo",
+        in_path=str(tmpdir), incremental="mtime")
+    actions = mapper.get_task()["actions"]
+    assert len(actions) == 1
+    assert actions[0](["dummy"])
+    assert log.read() == str(tmpdir.join("two.foo")) + "\n"
+    with pytest.raises(RuntimeError):
+        mapper.get_cmd_action("cat %(sources)s > all.bar")
+
+def test_hash_state_keeps_concurrent_updates(tmpdir):
+    state = fm.HashState(str(tmpdir.join("state.json")))
+    threads = [threading.Thread(target=state.update, args=({"t{}".format(i): {}},)) for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(state.load()) == 20
+
+def test_uptodate_checks_timestamps_of_all_pairs(tmpdir):
+    create_files(tmpdir, ["one.foo", "two.foo"], 1000)
+    create_files(tmpdir, ["one.bar", "two.bar"], 2000)
+    mapper = fm.GlobMapper(["one.foo", "two.foo"], None, "*.bar", "*.foo", in_path=str(tmpdir))
+    assert mapper.uptodate()
+    tmpdir.join("two.foo").setmtime(3000)
+    assert not mapper.uptodate()
+    assert [s.name for s, t in mapper.get_stale_map()] == ["two.foo"]
+
 def test_regexmapper_replaces_placeholders():
     p1 = pathlib.Path("one.foo")
     p2 = pathlib.Path("two.foo")
@@ -119,6 +382,52 @@ def test_regexmapper_generates_cmd_actions_from_string_callback():
     t = mapper.get_task()
     assert t["actions"] == ["mv one.foo one.bar", "mv two.foo two.bar"]
 
+def test_regexmapper_batches_sources_and_targets_placeholders():
+    sources = [pathlib.Path(n) for n in ["one.foo", "two.foo", "my three.foo"]]
+    mapper = fm.RegexMapper(sources, callback="convert %(sources)s --out %(targets)s", search=r"(.*)\.foo$", replace=r"\1.bar", batch_size=2)
+    t = mapper.get_task()
+    assert t["actions"] == [
+        "convert one.foo two.foo --out one.bar two.bar",
+        "convert 'my three.foo' --out 'my three.bar'",
+    ]
+
+def test_mergemapper_batches_split_when_target_changes():
+    sources = [pathlib.Path(n) for n in ["a1.foo", "a2.foo", "b1.foo"]]
+    mapper = fm.RegexMapper(sources, callback="cat %(sources)s >> %(target)s", search=r"^(.).*$", replace=r"\1.all")
+    assert mapper.get_task()["actions"] == ["cat a1.foo a2.foo >> a.all", "cat b1.foo >> b.all"]
+
+@mock.patch('doitfilemappers.filemappers._command_line_limit')
+def test_batch_commands_respect_command_line_limit(mock_limit):
+    mock_limit.return_value = len("rm ") + 2 * len("one.foo ")
+    sources = [pathlib.Path(n) for n in ["one.foo", "two.foo", "six.foo", "ten.foo"]]
+    mapper = fm.IdentityMapper(sources, callback="rm %(sources)s")
+    assert mapper.get_task()["actions"] == ["rm one.foo two.foo", "rm six.foo ten.foo"]
+
+@mock.patch('doitfilemappers.filemappers._command_line_limit')
+def test_batch_commands_count_each_placeholder_occurrence(mock_limit):
+    mock_limit.return_value = len("sort  -o  && wc  > ") + 2 * len("a.all") + 2 * 2 * len("a1.foo ")
+    sources = [pathlib.Path(n) for n in ["a1.foo", "a2.foo", "a3.foo", "a4.foo"]]
+    mapper = fm.RegexMapper(sources, callback="sort %(sources)s -o %(target)s && wc %(sources)s > %(target)s",
+        search=r"^(.).*$", replace=r"\1.all")
+    assert mapper.get_task()["actions"] == [
+        "sort a1.foo a2.foo -o a.all && wc a1.foo a2.foo > a.all",
+        "sort a3.foo a4.foo -o a.all && wc a3.foo a4.foo > a.all",
+    ]
+
+def test_batch_commands_reject_single_source_placeholder():
+    mapper = fm.IdentityMapper([pathlib.Path("one.foo")], callback="cp %(source)s %(sources)s")
+    with pytest.raises(RuntimeError):
+        mapper.get_task()
+
+def test_parallel_command_action_runs_all_commands_and_aggregates_status(tmpdir):
+    sources = [pathlib.Path(n) for n in ["one.foo", "two.foo", "three.foo"]]
+    cmd = "touch %(target)s && test %(source)s != two.foo"
+    mapper = fm.GlobMapper(sources, cmd, str(tmpdir.join("*.bar")), "*.foo", execution="thread", workers=2)
+    actions = mapper.get_task()["actions"]
+    assert len(actions) == 1
+    assert actions[0](["dummy"]) == False
+    assert sorted(os.listdir(str(tmpdir))) == ["one.bar", "three.bar", "two.bar"]
+
 @mock.patch('doitfilemappers.filemappers.pathlib.Path.glob')
 def test_globmapper_replaces_asterisk(mock_glob):
     p1 = pathlib.Path("one.foo")
@@ -148,15 +457,15 @@ def test_globmapper_uses_in_path_param():
 def test_globmapper_raises_exception_when_pattern_contains_more_than_one_asterisk():
     with pytest.raises(RuntimeError) as e:
         fm.GlobMapper("**/*.foo", replace="*.bar")
-    assert "asterisk" in e.value.message
+    assert "asterisk" in str(e.value)
     with pytest.raises(RuntimeError) as e:
         fm.GlobMapper(replace="*.bar", pattern="**/*.foo")
-    assert "asterisk" in e.value.message
+    assert "asterisk" in str(e.value)
 
 def test_globmapper_raises_exception_when_pattern_contains_no_asterisk():
     with pytest.raises(RuntimeError) as e:
         fm.GlobMapper("one.foo", None, "*.bar")
-    assert "asterisk" in e.value.message
+    assert "asterisk" in str(e.value)
 
 def test_mergemapper_returns_the_same_target_for_all_sources():
     p1 = pathlib.Path("one.foo")
@@ -181,7 +490,7 @@ def test_mergemapper_raises_exception_without_target():
     with pytest.raises(RuntimeError) as e:
         mapper = fm.MergeMapper("*.foo")
         mapper.get_map()
-    assert "Target" in e.value.message
+    assert "Target" in str(e.value)
 
 @mock.patch('doitfilemappers.filemappers.pathlib.Path.glob')
 def test_compositemapper_collects_from_all_sub_mappers(mock_glob):
@@ -199,6 +508,106 @@ def test_compositemapper_collects_from_all_sub_mappers(mock_glob):
     assert set(t["targets"]) == set(["one.bar","two.bar"])
     assert set(t["file_dep"]) == set(["one.foo","two.foo"])
 
+@mock.patch('doitfilemappers.filemappers.pathlib.Path.glob')
+def test_compositemapper_reads_shared_src_glob_once(mock_glob):
+    mock_glob.side_effect = lambda pattern: iter([pathlib.Path("a.jpg"), pathlib.Path("b.png"), pathlib.Path("c.jpg")])
+    sub_mappers = [
+        fm.GlobMapper("*", replace="*.thumb", pattern="*.jpg"),
+        fm.GlobMapper("*", replace="*.thumb", pattern="*.png"),
+    ]
+    mapper = fm.CompositeMapper(sub_mappers)
+    m = mapper.get_map()
+    assert mock_glob.call_count == 1
+    assert m == [
+        (pathlib.Path("a.jpg"), pathlib.Path("a.thumb")),
+        (pathlib.Path("c.jpg"), pathlib.Path("c.thumb")),
+        (pathlib.Path("b.png"), pathlib.Path("b.thumb")),
+    ]
+
+@mock.patch('doitfilemappers.filemappers.pathlib.Path.glob')
+def test_compositemapper_dispatch_produces_same_map_as_sub_mappers(mock_glob):
+    names = ["a.jpg", "b.jpeg", "img_c.jpg", "d.JPG", "e.txt", ".jpg", "f.tar.gz"]
+    mock_glob.side_effect = lambda pattern: iter([pathlib.Path(n) for n in names])
+    def create_sub_mappers(src):
+        return [
+            fm.GlobMapper(src, replace="*.thumb", pattern="*.jpg"),
+            fm.RegexMapper(src, search=r"^(.*)\.jpe?g$", replace=r"\1.regex"),
+            fm.GlobMapper(src, replace="small_*", pattern="img_*.jpg"),
+            fm.GlobMapper(src, replace="*.upper", pattern="*.jpg", flags=re.IGNORECASE),
+            fm.RegexMapper(src, search=r"\.gz$", replace=r".unzipped", ignore_nonmatching=False),
+        ]
+    expected = []
+    for sub_mapper in create_sub_mappers("*"):
+        expected += sub_mapper.get_map()
+    assert len(expected) == 17
+    assert fm.CompositeMapper(create_sub_mappers("*")).get_map() == expected
+
+class LowerCaseMapper(fm.GlobMapper):
+    def _source_matches(self, source):
+        return str(source).endswith(".jpg")
+
+    def _get_target_from_source(self, source):
+        return pathlib.Path(str(source).lower().replace(".jpg", ".thumb"))
+
+class SuffixMapper(fm.RegexMapper):
+    def _source_matches(self, source):
+        return source.suffix == ".jpg"
+
+    def _get_target_from_source(self, source):
+        return source.with_suffix(".thumb")
+
+def test_regexmapper_hooks_get_source_paths():
+    mapper = SuffixMapper([pathlib.Path("a.jpg"), pathlib.Path("b.png")])
+    assert mapper.get_map() == [(pathlib.Path("a.jpg"), pathlib.Path("a.thumb"))]
+    assert fm.CompositeMapper([SuffixMapper([pathlib.Path("a.jpg")])]).get_map() == mapper.get_map()
+
+@mock.patch('doitfilemappers.filemappers.pathlib.Path.glob')
+def test_regexmapper_subclasses_can_override_matching_and_targets(mock_glob):
+    mock_glob.side_effect = lambda pattern: iter([pathlib.Path(n) for n in ["A.jpg", "b.png"]])
+    mapper = LowerCaseMapper("*", replace="*.thumb", pattern="*.JPG")
+    assert not fm.PatternDispatcher.can_dispatch(mapper)
+    assert mapper.get_map() == [(pathlib.Path("A.jpg"), pathlib.Path("a.thumb"))]
+    assert fm.CompositeMapper([LowerCaseMapper("*", replace="*.thumb", pattern="*.JPG")]).get_map() == mapper.get_map()
+
+def create_mock_mapper(pairs):
+    sub_mapper = mock.MagicMock()
+    sub_mapper.get_map.return_value = [(pathlib.Path(s), pathlib.Path(t)) for s, t in pairs]
+    return sub_mapper
+
+def test_compositemapper_drops_duplicate_pairs():
+    sub_mappers = [create_mock_mapper([("a.jpg", "a.png"), ("b.jpg", "b.png")]), create_mock_mapper([("a.jpg", "a.png")])]
+    mapper = fm.CompositeMapper(sub_mappers, "convert %(source)s %(target)s")
+    assert mapper.get_map() == [(pathlib.Path("a.jpg"), pathlib.Path("a.png")), (pathlib.Path("b.jpg"), pathlib.Path("b.png"))]
+    assert len(fm.CompositeMapper(sub_mappers, deduplicate=False).get_map()) == 3
+
+def test_compositemapper_emits_ordered_unique_targets_and_file_dep():
+    sub_mappers = [
+        create_mock_mapper([("b.jpg", "b.png"), ("a.jpg", "a.png")]),
+        create_mock_mapper([("b.jpg", "b.gif"), ("c.jpg", "a.png")]),
+    ]
+    task = fm.CompositeMapper(sub_mappers, "convert %(source)s %(target)s").get_task()
+    assert task["targets"] == ["b.png", "a.png", "b.gif"]
+    assert task["file_dep"] == ["b.jpg", "a.jpg", "c.jpg"]
+
+def test_compositemapper_raises_exception_on_collision():
+    sub_mappers = [create_mock_mapper([("a.jpg", "a.png")]), create_mock_mapper([("a.jpeg", "a.png")])]
+    mapper = fm.CompositeMapper(sub_mappers, on_collision="error")
+    with pytest.raises(RuntimeError) as e:
+        mapper.get_map()
+    assert "a.png from a.jpg, a.jpeg" in str(e.value)
+
+def test_compositemapper_merges_colliding_targets(tmpdir):
+    create_files(tmpdir, ["a.txt", "b.txt", "a.log"])
+    sub_mappers = [
+        fm.GlobMapper(["a.txt", "b.txt"], replace="*.out", pattern="*.txt", in_path=str(tmpdir)),
+        fm.GlobMapper(["a.log"], replace="*.out", pattern="*.log", in_path=str(tmpdir)),
+    ]
+    mapper = fm.CompositeMapper(sub_mappers, upper_case, on_collision="merge")
+    mapper.get_task()["actions"][0](["dummy"])
+    assert list(mapper.collisions) == [str(tmpdir.join("a.out"))]
+    assert [t for s, t in mapper.get_map()][:2] == [pathlib.Path(str(tmpdir.join("a.out")))] * 2
+    assert tmpdir.join("a.out").read() == "A.TXTA.LOG"
+
 def test_chainmapper_yields_for_all_subtasks():
     m1 = mock.Mock()
     m1.get_task.return_value = {"actions":["touch foo"], "targets":["foo"]}
@@ -235,6 +644,164 @@ def test_chainmapper_returns_combined_map_if_callback_is_given():
     assert task["targets"] == ["bar"]
     assert task["file_dep"] == ["start"]
 
+def test_compactmap_iterates_as_path_pairs():
+    pairs = [
+        (pathlib.Path("data/one.foo"), pathlib.Path("out/one.bar")),
+        (pathlib.Path("data/two.foo"), pathlib.Path("out/two.bar")),
+        (pathlib.Path("three.foo"), pathlib.Path("/abs/three.bar")),
+    ]
+    m = fm.CompactMap(pairs)
+    assert len(m) == 3
+    assert list(m) == pairs
+    assert m == pairs
+    assert m[1] == pairs[1]
+    assert m[-1] == pairs[2]
+    assert list(m.iter_names()) == [(str(s), str(t)) for s, t in pairs]
+
+def test_compactmap_stores_directories_once():
+    m = fm.CompactMap((pathlib.Path("data/{}.foo".format(i)), pathlib.Path("data/{}.bar".format(i))) for i in range(100))
+    assert len(m._dirs) == 1
+
+def test_regexmapper_with_compact_map_returns_same_task():
+    p1 = pathlib.Path("src/one.foo")
+    p2 = pathlib.Path("src/two.foo")
+    mapper = fm.RegexMapper([p1, p2], "mv %(source)s %(target)s", search=r"(.*)\.foo$", replace=r"\1.bar", compact_map=True)
+    assert isinstance(mapper.get_map(), fm.CompactMap)
+    t = mapper.get_task()
+    assert sorted(t["targets"]) == ["src/one.bar", "src/two.bar"]
+    assert t["file_dep"] == ["src/one.foo", "src/two.foo"]
+    assert t["actions"] == ["mv src/one.foo src/one.bar", "mv src/two.foo src/two.bar"]
+
+def test_compact_map_action_calls_callback_with_paths():
+    p1 = pathlib.Path("one.foo")
+    custom_callback = mock.Mock(return_value=True)
+    mapper = fm.IdentityMapper([p1], custom_callback, compact_map=True)
+    assert mapper.get_action(mapper.callback)(["dummy"])
+    assert custom_callback.call_args_list == [mock.call(p1, p1)]
+
+def test_chainmapper_map_follows_files_through_filtering_and_merging_stages():
+    sources = [pathlib.Path(n) for n in ["a.txt", "b.txt", "c.txt"]]
+    sub_mappers = [
+        fm.GlobMapper(replace="*.tmp", pattern="*.txt"),
+        fm.RegexMapper(search=r"^([ac])\.tmp$", replace=r"\1.filtered"),
+        fm.MergeMapper(target="all.out"),
+    ]
+    mapper = fm.ChainedMapper(sources, sub_mappers=sub_mappers, callback=mock.Mock())
+    assert mapper.get_map() == [
+        (pathlib.Path("a.txt"), pathlib.Path("all.out")),
+        (pathlib.Path("c.txt"), pathlib.Path("all.out")),
+    ]
+    assert mapper.chains[0] == (pathlib.Path("a.txt"), pathlib.Path("a.tmp"), pathlib.Path("a.filtered"), pathlib.Path("all.out"))
+
+def test_chainmapper_map_pairs_sources_with_their_own_targets():
+    m1 = mock.Mock()
+    m1.get_map.return_value = [("one", "one.tmp"), ("two", "two.tmp"), ("three", "three.tmp")]
+    m2 = mock.Mock()
+    m2.get_map.return_value = [("three.tmp", "three.out"), ("one.tmp", "one.out")]
+    mapper = fm.ChainedMapper(src="start", sub_mappers=[m1, m2], callback=mock.Mock())
+    assert mapper.get_map() == [("one", "one.out"), ("three", "three.out")]
+    assert m2.src == ["one.tmp", "two.tmp", "three.tmp"]
+
+def test_chainmapper_map_is_empty_if_a_stage_is_empty_and_empty_maps_are_allowed():
+    m1 = mock.Mock()
+    m1.get_map.return_value = [("one", "one.tmp")]
+    m2 = mock.Mock()
+    m2.get_map.return_value = []
+    mapper = fm.ChainedMapper(src="start", sub_mappers=[m1, m2], callback=mock.Mock(), allow_empty_map=True)
+    assert mapper.get_map() == []
+
+@fm.open_files
+def upper_case(_in, _out):
+    _out.write(_in.read().upper())
+
+@fm.open_files_with_merge
+def add_line_break(_in, _out):
+    _out.write(_in.read() + u"\n")
+
+def test_chainmapper_fused_writes_only_final_targets(tmpdir):
+    create_files(tmpdir, ["one.txt", "two.txt"])
+    sub_mappers = [
+        fm.GlobMapper(callback=upper_case, replace="*.tmp", pattern="*.txt"),
+        fm.MergeMapper(callback=add_line_break, target=str(tmpdir.join("all.out"))),
+    ]
+    mapper = fm.ChainedMapper(["one.txt", "two.txt"], sub_mappers=sub_mappers, in_path=str(tmpdir), fused=True)
+    tasks = list(mapper.get_task())
+    assert len(tasks) == 1
+    assert tasks[0]["name"] == "fused_chain"
+    assert tasks[0]["targets"] == [str(tmpdir.join("all.out"))]
+    assert tasks[0]["actions"][0](["dummy"])
+    assert tmpdir.join("all.out").read() == "ONE.TXT\nTWO.TXT\n"
+    assert not tmpdir.join("one.tmp").exists()
+
+def test_chainmapper_fused_requires_file_callbacks():
+    m1 = fm.IdentityMapper([pathlib.Path("one.txt")], callback="cp %(source)s %(target)s")
+    mapper = fm.ChainedMapper([pathlib.Path("one.txt")], sub_mappers=[m1], fused=True)
+    with pytest.raises(RuntimeError) as e:
+        list(mapper.get_task())
+    assert "open_files" in str(e.value)
+
+def test_chainmapper_fused_rejects_intermediate_merges():
+    sources = [pathlib.Path("one.txt"), pathlib.Path("two.txt")]
+    sub_mappers = [
+        fm.MergeMapper(callback=add_line_break, target="all.tmp"),
+        fm.GlobMapper(callback=upper_case, replace="*.out", pattern="*.tmp"),
+    ]
+    mapper = fm.ChainedMapper(sources, sub_mappers=sub_mappers, fused=True)
+    with pytest.raises(RuntimeError) as e:
+        list(mapper.get_task())
+    assert "more than one source" in str(e.value)
+
+def test_chainmapper_pipelined_starts_next_stage_before_stage_is_finished(tmpdir):
+    create_files(tmpdir, ["a.txt", "b.txt"])
+    second_stage_started = threading.Event()
+    def first(_in, _out):
+        if "b" in str(_in):
+            second_stage_started.wait(5)
+        _out.write(_in.read() + ">1")
+    def second(_in, _out):
+        second_stage_started.set()
+        _out.write(_in.read() + ">2")
+    sub_mappers = [
+        fm.GlobMapper(callback=fm.open_files(first), replace="*.tmp", pattern="*.txt", workers=1),
+        fm.GlobMapper(callback=fm.open_files(second), replace="*.out", pattern="*.tmp", workers=1),
+        fm.MergeMapper(callback=add_line_break, target=str(tmpdir.join("all.out"))),
+    ]
+    mapper = fm.ChainedMapper(["a.txt", "b.txt"], sub_mappers=sub_mappers, in_path=str(tmpdir), pipelined=True)
+    tasks = list(mapper.get_task())
+    assert len(tasks) == 1
+    assert tasks[0]["name"] == "pipelined_chain"
+    assert tasks[0]["file_dep"] == [str(tmpdir.join("a.txt")), str(tmpdir.join("b.txt"))]
+    assert tasks[0]["targets"][-1] == str(tmpdir.join("all.out"))
+    assert tasks[0]["actions"][0](["dummy"])
+    assert second_stage_started.is_set()
+    assert tmpdir.join("b.out").read() == "b.txt>1>2"
+    assert sorted(tmpdir.join("all.out").read().splitlines()) == ["a.txt>1>2", "b.txt>1>2"]
+
+def test_chainmapper_pipelined_skips_files_after_failed_stage():
+    second = mock.Mock(return_value=True)
+    sub_mappers = [
+        fm.GlobMapper(callback=lambda _in, _out: "b" not in str(_in), replace="*.tmp", pattern="*.txt"),
+        fm.GlobMapper(callback=second, replace="*.out", pattern="*.tmp"),
+    ]
+    mapper = fm.ChainedMapper(["a.txt", "b.txt"], sub_mappers=sub_mappers, pipelined=True)
+    assert list(mapper.get_task())[0]["actions"][0](["dummy"]) == False
+    second.assert_called_once_with(pathlib.Path("a.tmp"), pathlib.Path("a.out"))
+
+def test_chainmapper_pipelined_stops_on_unhandled_exception():
+    second = mock.Mock(return_value=True)
+    sub_mappers = [
+        fm.GlobMapper(callback=mock.Mock(side_effect=ValueError("broken")), replace="*.tmp", pattern="*.txt"),
+        fm.GlobMapper(callback=second, replace="*.out", pattern="*.tmp"),
+    ]
+    mapper = fm.ChainedMapper(["a.txt", "b.txt"], sub_mappers=sub_mappers, pipelined=True)
+    with pytest.raises(ValueError):
+        list(mapper.get_task())[0]["actions"][0](["dummy"])
+    assert not second.called
+
+def test_chainmapper_cant_be_fused_and_pipelined():
+    with pytest.raises(RuntimeError):
+        fm.ChainedMapper(["a.txt"], sub_mappers=[], fused=True, pipelined=True)
+
 def test_file_handle_decorator_opens_files():
     @fm.open_files
     def check(_in, _out):
@@ -245,6 +812,44 @@ def test_file_handle_decorator_opens_files():
     p_in.open.assert_called_with("r")
     p_out.open.assert_called_with("w")
 
+def test_mmap_decorator_passes_mapped_source(tmpdir):
+    create_files(tmpdir, ["one.txt", "empty.txt"])
+    tmpdir.join("empty.txt").write("")
+    @fm.open_files_mmap
+    def check(data, _out):
+        _out.write(data[:3] + b"|" + data[-3:])
+        return len(data)
+    assert check(pathlib.Path(str(tmpdir.join("one.txt"))), pathlib.Path(str(tmpdir.join("one.out")))) == 7
+    assert tmpdir.join("one.out").read() == "one|txt"
+    assert check(pathlib.Path(str(tmpdir.join("empty.txt"))), pathlib.Path(str(tmpdir.join("empty.out")))) == 0
+
+def test_fast_copy_copies_content_and_mode(tmpdir):
+    source = tmpdir.join("one.sh")
+    source.write("x" * 100000)
+    source.chmod(0o750)
+    assert fm.fast_copy(pathlib.Path(str(source)), pathlib.Path(str(tmpdir.join("copy.sh"))))
+    assert tmpdir.join("copy.sh").read() == "x" * 100000
+    assert tmpdir.join("copy.sh").stat().mode & 0o777 == 0o750
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="sendfile is only used on Linux")
+def test_fast_copy_uses_kernel_copy_on_linux(tmpdir):
+    assert fm._kernel_copy_functions()
+    copy = fm._libc_sendfile()
+    source = tmpdir.join("one.txt")
+    source.write("0123456789")
+    with source.open("rb") as in_handle, tmpdir.join("copy.txt").open("wb") as out_handle:
+        assert copy(in_handle.fileno(), out_handle.fileno(), 2, 5) == 5
+    assert tmpdir.join("copy.txt").read() == "23456"
+
+@mock.patch('doitfilemappers.filemappers._kernel_copy_functions')
+def test_fast_copy_falls_back_if_kernel_copy_is_not_supported(mock_functions, tmpdir):
+    create_files(tmpdir, ["one.txt"])
+    def unsupported(in_fd, out_fd, offset, count):
+        raise OSError(fm.errno.EXDEV, "Invalid cross-device link")
+    mock_functions.return_value = [unsupported]
+    fm.fast_copy(pathlib.Path(str(tmpdir.join("one.txt"))), pathlib.Path(str(tmpdir.join("copy.txt"))))
+    assert tmpdir.join("copy.txt").read() == "one.txt"
+
 def test_track_file_count_tracks_calls():
     @fm.track_file_count
     def check(_in, _out, file_count=0):
@@ -253,6 +858,36 @@ def test_track_file_count_tracks_calls():
     assert check(None, None) == 1
     assert check(None, None) == 2
 
+@mock.patch('doitfilemappers.filemappers._fork_context', side_effect=OSError("no /dev/shm"))
+def test_track_file_count_does_not_need_shared_memory_in_serial_mode(mock_value):
+    @fm.track_file_count
+    def check(_in, _out, file_count=0):
+        return file_count
+    assert [check(None, None), check(None, None)] == [0, 1]
+
+def test_track_file_count_counts_across_worker_processes(tmpdir):
+    create_files(tmpdir, ["{}.foo".format(i) for i in range(6)])
+    @fm.open_files
+    @fm.track_file_count
+    def write_count(_in, _out, file_count=0):
+        _out.write(u"{}".format(file_count))
+    mapper = fm.GlobMapper("*.foo", write_count, "*.bar", in_path=str(tmpdir), execution="process", workers=3)
+    assert mapper.get_task()["actions"][0](["dummy"])
+    assert sorted(int(tmpdir.join("{}.bar".format(i)).read()) for i in range(6)) == list(range(6))
+
+@pytest.mark.skipif(not hasattr(multiprocessing, "get_context"), reason="Python 2 always forks")
+def test_process_execution_forks_regardless_of_start_method(tmpdir):
+    create_files(tmpdir, ["one.foo", "two.foo"])
+    start_method = multiprocessing.get_start_method(allow_none=True)
+    multiprocessing.set_start_method("spawn", force=True)
+    try:
+        mapper = fm.GlobMapper("*.foo", lambda s, t: shutil.copy(str(s), str(t)), "*.bar", in_path=str(tmpdir),
+            execution="process", workers=2)
+        mapper.get_task()["actions"][0](["dummy"])
+    finally:
+        multiprocessing.set_start_method(start_method, force=True)
+    assert tmpdir.join("two.bar").read() == "two.foo"
+
 def test_merge_file_handle_decorator_opens_files():
     @fm.open_files_with_merge
     def check(_in, _out):
@@ -264,3 +899,326 @@ def test_merge_file_handle_decorator_opens_files():
     p_out1.open.assert_called_once_with("w")
     check(p_in, p_out2)
     p_out2.open.assert_called_once_with("a")
+
+def test_merge_file_handle_decorator_keeps_targets_open():
+    def check(_in, _out):
+        pass
+    opener = fm.open_files_with_merge(check, max_open=2)
+    p_in = get_path_open_mock("in")
+    p_out = get_path_open_mock("out")
+    opener(p_in, p_out)
+    opener(p_in, p_out)
+    p_out.open.assert_called_once_with("w", fm.MERGE_BUFFER_SIZE)
+    assert not p_out.open.return_value.close.called
+    opener.close()
+    assert p_out.open.return_value.close.called
+
+def test_merge_file_handle_decorator_reopens_evicted_targets_in_append_mode(tmpdir):
+    create_files(tmpdir, ["one.txt", "two.txt", "three.txt"])
+    def write(_in, _out):
+        _out.write(_in.read())
+    opener = fm.open_files_with_merge(write, max_open=1)
+    a, b = pathlib.Path(str(tmpdir.join("a.out"))), pathlib.Path(str(tmpdir.join("b.out")))
+    opener(pathlib.Path(str(tmpdir.join("one.txt"))), a)
+    opener(pathlib.Path(str(tmpdir.join("two.txt"))), b)
+    opener(pathlib.Path(str(tmpdir.join("three.txt"))), a)
+    opener.close()
+    assert tmpdir.join("a.out").read() == "one.txtthree.txt"
+    assert tmpdir.join("b.out").read() == "two.txt"
+
+def test_handle_pool_does_not_close_handles_in_use():
+    pool = fm.HandlePool(1)
+    p_one = get_path_open_mock("one")
+    p_two = get_path_open_mock("two")
+    pool.acquire(p_one)
+    pool.acquire(p_two)
+    assert not p_one.open.return_value.close.called
+    pool.release(p_one)
+    pool.close()
+    assert p_one.open.return_value.close.called
+    assert not p_two.open.return_value.close.called
+
+@pytest.mark.parametrize("execution", ["serial", "thread", "process"])
+def test_action_closes_merge_handles_when_finished(tmpdir, execution):
+    create_files(tmpdir, ["a1.txt", "a2.txt", "b1.txt"])
+    def write(_in, _out):
+        _out.write(_in.read())
+    callback = fm.open_files_with_merge(write, max_open=4)
+    mapper = fm.RegexMapper(["a1.txt", "b1.txt", "a2.txt"], callback, search=r"(\w)\d\.txt$", replace=r"\1.out",
+        in_path=str(tmpdir), execution=execution, workers=2)
+    assert mapper.get_task()["actions"][0](["dummy"])
+    assert tmpdir.join("a.out").read() == "a1.txta2.txt"
+    assert tmpdir.join("b.out").read() == "b1.txt"
+
+def test_stream_records_transforms_lines_in_batches(tmpdir):
+    tmpdir.join("in.txt").write("one\ntwo\nthree\n")
+    callback = fm.stream_records(lambda line: None if line.startswith("t") and "w" in line else line.upper(), batch_size=1)
+    assert callback(pathlib.Path(str(tmpdir.join("in.txt"))), pathlib.Path(str(tmpdir.join("out.txt"))))
+    assert tmpdir.join("out.txt").read() == "ONE\nTHREE\n"
+
+def test_stream_records_transforms_csv_rows(tmpdir):
+    tmpdir.join("in.csv").write("a,b\n1,2\n")
+    callback = fm.stream_records(lambda row: list(reversed(row)), record="csv")
+    callback(pathlib.Path(str(tmpdir.join("in.csv"))), pathlib.Path(str(tmpdir.join("out.csv"))))
+    assert tmpdir.join("out.csv").read().splitlines() == ["b,a", "2,1"]
+
+def test_stream_records_keeps_line_breaks_in_csv_fields(tmpdir):
+    tmpdir.join("in.csv").write_binary(b'a,"one\r\ntwo"\r\n')
+    callback = fm.stream_records(lambda row: row, record="csv")
+    callback(pathlib.Path(str(tmpdir.join("in.csv"))), pathlib.Path(str(tmpdir.join("out.csv"))))
+    assert tmpdir.join("out.csv").read_binary() == b'a,"one\r\ntwo"\r\n'
+
+def test_stream_records_passes_file_count_to_func(tmpdir):
+    tmpdir.join("one.txt").write("a\nb\n")
+    tmpdir.join("two.txt").write("c\n")
+    callback = fm.track_file_count(fm.stream_records(lambda line, file_count: u"{}{}".format(file_count, line)))
+    for name in ["one", "two"]:
+        assert callback(pathlib.Path(str(tmpdir.join(name + ".txt"))), pathlib.Path(str(tmpdir.join(name + ".out"))))
+    assert tmpdir.join("one.out").read() == "0a\n0b\n"
+    assert tmpdir.join("two.out").read() == "1c\n"
+
+def test_stream_records_transforms_chunks(tmpdir):
+    tmpdir.join("in.bin").write("abcdefg")
+    chunks = []
+    def collect(chunk):
+        chunks.append(chunk)
+        return chunk
+    callback = fm.stream_records(collect, record="chunk", chunk_size=3)
+    callback(pathlib.Path(str(tmpdir.join("in.bin"))), pathlib.Path(str(tmpdir.join("out.bin"))))
+    assert chunks == [b"abc", b"def", b"g"]
+    assert tmpdir.join("out.bin").read() == "abcdefg"
+
+def test_stream_records_merges_sources(tmpdir):
+    tmpdir.join("one.txt").write("one\n")
+    tmpdir.join("two.txt").write("two\n")
+    callback = fm.stream_records(lambda line: line.upper(), merge=True)
+    mapper = fm.MergeMapper(["one.txt", "two.txt"], callback, target=str(tmpdir.join("all.txt")), in_path=str(tmpdir))
+    assert mapper.get_task()["actions"][0](["dummy"])
+    assert tmpdir.join("all.txt").read() == "ONE\nTWO\n"
+
+def test_stream_records_rejects_unknown_record_types():
+    with pytest.raises(RuntimeError) as e:
+        fm.stream_records(lambda r: r, record="xml")
+    assert "record must be one of" in str(e.value)
+
+def test_get_tasks_yields_one_task_per_target():
+    callback = mock.Mock()
+    mapper = fm.GlobMapper(["one.foo", "two.foo"], callback, "*.bar", "*.foo")
+    tasks = list(mapper.get_tasks({"basename": "convert"}))
+    assert [t["name"] for t in tasks] == ["one.bar", "two.bar"]
+    assert tasks[1]["targets"] == ["two.bar"]
+    assert tasks[1]["file_dep"] == ["two.foo"]
+    assert tasks[1]["basename"] == "convert"
+    tasks[1]["actions"][0](["dummy"])
+    callback.assert_called_once_with(pathlib.Path("two.foo"), pathlib.Path("two.bar"))
+
+def test_get_tasks_keeps_pairs_of_a_target_in_one_shard():
+    mapper = fm.RegexMapper(["a1", "a2", "a3", "b1", "c1"], "cat %(source)s >> %(target)s", search=r"(\w)\d", replace=r"\1.out")
+    tasks = list(mapper.get_tasks(shard_size=2))
+    assert [t["name"] for t in tasks] == ["shard1", "shard2"]
+    assert tasks[0]["file_dep"] == ["a1", "a2", "a3"]
+    assert sorted(tasks[1]["targets"]) == ["b.out", "c.out"]
+    assert tasks[1]["actions"] == ["cat b1 >> b.out", "cat c1 >> c.out"]
+
+def test_get_tasks_shards_by_target_directory():
+    mapper = fm.IdentityMapper(["a/one", "b/two", "a/three"], "touch %(target)s")
+    tasks = list(mapper.get_tasks(by_directory=True))
+    assert [t["name"] for t in tasks] == ["a", "b"]
+    assert sorted(tasks[0]["targets"]) == ["a/one", "a/three"]
+
+def test_get_tasks_yields_named_task_for_allowed_empty_map():
+    mapper = fm.IdentityMapper([], "touch %(target)s", allow_empty_map=True)
+    tasks = list(mapper.get_tasks())
+    assert len(tasks) == 1
+    assert tasks[0]["name"] == "empty"
+
+def test_chainmapper_get_tasks_splits_each_stage():
+    sub_mappers = [
+        fm.GlobMapper(callback="cp %(source)s %(target)s", replace="*.tmp", pattern="*.txt"),
+        fm.MergeMapper(callback="cat %(source)s >> %(target)s", target="all.out"),
+    ]
+    mapper = fm.ChainedMapper(["one.txt", "two.txt"], sub_mappers=sub_mappers)
+    tasks = list(mapper.get_tasks())
+    assert [t["name"] for t in tasks] == ["GlobMapper1/one.tmp", "GlobMapper1/two.tmp", "MergeMapper1/all.out"]
+    assert tasks[2]["file_dep"] == ["one.tmp", "two.tmp"]
+
+def test_partitions_split_map_and_keep_targets_together():
+    sources = ["{}{}.txt".format(c, i) for c in "abcdefgh" for i in range(3)]
+    def create_mapper(index):
+        return fm.RegexMapper(sources, "cat %(source)s >> %(target)s", search=r"(\w)\d\.txt", replace=r"\1.out",
+            partition=(index, 3))
+    maps = [create_mapper(i).get_map() for i in range(3)]
+    assert sorted(p for m in maps for p in m) == sorted(fm.RegexMapper(sources, search=r"(\w)\d\.txt", replace=r"\1.out").get_map())
+    targets = [set(str(t) for s, t in m) for m in maps]
+    assert not targets[0] & targets[1] and not targets[1] & targets[2] and not targets[0] & targets[2]
+    assert maps == [create_mapper(i).get_map() for i in range(3)]
+
+@mock.patch.dict(os.environ, {"FILEMAPPER_PARTITION_INDEX": "1", "FILEMAPPER_PARTITION_COUNT": "4"})
+def test_partition_is_read_from_environment():
+    assert fm.IdentityMapper([], partition=True).partition == (1, 4)
+
+def test_partition_index_must_be_smaller_than_count():
+    with pytest.raises(RuntimeError) as e:
+        fm.IdentityMapper([], partition=(2, 2))
+    assert "partition" in str(e.value)
+
+def test_partition_manifests_are_used_to_verify_coverage(tmpdir):
+    create_files(tmpdir, ["{}.txt".format(i) for i in range(10)])
+    def create_mapper(index):
+        return fm.GlobMapper("*.txt", mock.Mock(), "*.out", in_path=str(tmpdir), partition=(index, 2),
+            partition_manifest=str(tmpdir.join("manifest-{index}-{count}.json")))
+    mapper = create_mapper(0)
+    mapper.get_task()["actions"][0](["dummy"])
+    manifest = json.loads(tmpdir.join("manifest-0-2.json").read())
+    assert manifest["completed"] == sorted(str(t) for s, t in mapper.get_map())
+    assert manifest["failed"] == []
+    missing = mapper.verify_partition_coverage()
+    assert sorted(missing) == sorted(str(t) for s, t in create_mapper(1).get_map())
+    create_mapper(1).get_task()["actions"][0](["dummy"])
+    assert mapper.verify_partition_coverage() == []
+
+def test_partition_manifest_keeps_targets_of_parallel_sub_tasks(tmpdir):
+    create_files(tmpdir, ["{}.txt".format(i) for i in range(10)])
+    mapper = fm.GlobMapper("*.txt", mock.Mock(return_value=True), "*.out", in_path=str(tmpdir), partition=(0, 1),
+        partition_manifest=str(tmpdir.join("manifest-{index}-{count}.json")))
+    threads = [threading.Thread(target=t["actions"][0], args=(["dummy"],)) for t in mapper.get_tasks()]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert mapper.verify_partition_coverage() == []
+
+def test_failure_manifest_lists_failed_pairs_and_retry_runs_only_them(tmpdir):
+    manifest = tmpdir.join("failures.json")
+    def fail_on_two(_in, _out):
+        if "two" in str(_in):
+            raise IOError("broken")
+        return "three" not in str(_in)
+    callback = mock.Mock(side_effect=fail_on_two)
+    mapper = fm.GlobMapper(["one.foo", "two.foo", "three.foo"], callback, "*.bar", "*.foo",
+        error_handling=(IOError, lambda e: False), failure_manifest=str(manifest))
+    assert mapper.get_task()["actions"][0](["dummy"]) == False
+    data = json.loads(manifest.read())
+    assert data["failed"] == [
+        {"source": "two.foo", "target": "two.bar", "error": IOError.__name__ + ": broken"},
+        {"source": "three.foo", "target": "three.bar", "error": "Callback returned False"},
+    ]
+    assert data["unfinished"] == []
+
+    callback.reset_mock()
+    callback.side_effect = None
+    callback.return_value = True
+    retry_mapper = fm.GlobMapper(["one.foo", "two.foo", "three.foo"], callback, "*.bar", "*.foo",
+        failure_manifest=str(manifest), retry_failed=True)
+    assert retry_mapper.get_task()["actions"][0](["dummy"])
+    assert callback.call_args_list == [
+        mock.call(pathlib.Path("two.foo"), pathlib.Path("two.bar")),
+        mock.call(pathlib.Path("three.foo"), pathlib.Path("three.bar")),
+    ]
+    assert not manifest.exists()
+
+def test_failure_manifest_lists_unfinished_pairs_after_unhandled_error(tmpdir):
+    manifest = tmpdir.join("failures.json")
+    callback = mock.Mock(side_effect=[True, RuntimeError("stop")])
+    mapper = fm.GlobMapper(["one.foo", "two.foo", "three.foo"], callback, "*.bar", "*.foo", failure_manifest=str(manifest))
+    with pytest.raises(RuntimeError):
+        mapper.get_task()["actions"][0](["dummy"])
+    data = json.loads(manifest.read())
+    assert data["failed"] == [{"source": None, "target": None, "error": "RuntimeError: stop"}]
+    assert data["unfinished"] == [{"source": "two.foo", "target": "two.bar"}, {"source": "three.foo", "target": "three.bar"}]
+
+def test_failure_manifest_keeps_entries_of_other_sub_tasks(tmpdir):
+    manifest = tmpdir.join("failures.json")
+    callback = mock.Mock(side_effect=lambda _in, _out: "one" not in str(_in))
+    mapper = fm.GlobMapper(["one.foo", "two.foo", "three.foo"], callback, "*.bar", "*.foo",
+        failure_manifest=str(manifest))
+    for task in mapper.get_tasks():
+        task["actions"][0](["dummy"])
+    data = json.loads(manifest.read())
+    assert [e["target"] for e in data["failed"]] == ["one.bar"]
+
+def test_manifests_accept_path_objects(tmpdir):
+    manifest = pathlib.Path(str(tmpdir.join("failures.json")))
+    mapper = fm.GlobMapper(["one.foo"], mock.Mock(return_value=False), "*.bar", "*.foo",
+        failure_manifest=manifest, partition=(0, 1),
+        partition_manifest=pathlib.Path(str(tmpdir.join("manifest-{index}-{count}.json"))))
+    assert mapper.get_task()["actions"][0](["dummy"]) == False
+    assert [e["target"] for e in json.loads(tmpdir.join("failures.json").read())["failed"]] == ["one.bar"]
+    assert json.loads(tmpdir.join("manifest-0-1.json").read())["failed"] == ["one.bar"]
+
+def test_retry_failed_runs_commands_only_for_failed_pairs(tmpdir):
+    manifest = tmpdir.join("failures.json")
+    manifest.write(json.dumps({"failed": [{"source": "two.foo", "target": "two.bar", "error": "x"}], "unfinished": []}))
+    log = tmpdir.join("log")
+    mapper = fm.GlobMapper(["one.foo", "two.foo"], "echo %(source)s >> " + str(log), "*.bar", "*.foo",
+        failure_manifest=str(manifest), retry_failed=True)
+    actions = mapper.get_task()["actions"]
+    assert len(actions) == 1
+    assert actions[0](["dummy"])
+    assert log.read() == "two.foo\n"
+    assert not manifest.exists()
+    with pytest.raises(RuntimeError):
+        mapper.get_cmd_action("cat %(sources)s > all.bar")
+
+def test_retry_failed_needs_failure_manifest():
+    with pytest.raises(RuntimeError) as e:
+        fm.IdentityMapper([], retry_failed=True)
+    assert "failure_manifest" in str(e.value)
+
+def test_pack_balanced_distributes_sizes_evenly():
+    assert fm._pack_balanced(["a", "b", "c", "d", "e", "f"], [10, 9, 8, 3, 2, 1], 2) == [["b", "c"], ["a", "d", "e", "f"]]
+    assert fm._pack_balanced(["a", "b", "c", "d", "e", "f"], [10, 9, 8, 3, 2, 1], 2, capacity=3) == [["b", "c", "f"], ["a", "d", "e"]]
+
+def create_sized_files(tmpdir, sizes):
+    for name, size in sizes.items():
+        tmpdir.join(name).write("x" * size)
+
+def test_action_processes_largest_sources_first(tmpdir):
+    create_sized_files(tmpdir, {"a.foo": 1, "b.foo": 30, "c.foo": 20})
+    callback = mock.Mock(return_value=True)
+    mapper = fm.GlobMapper("*.foo", callback, "*.bar", in_path=str(tmpdir), order="largest_first")
+    mapper.get_task()["actions"][0](["dummy"])
+    assert [os.path.basename(str(c[0][0])) for c in callback.call_args_list] == ["b.foo", "c.foo", "a.foo"]
+
+def test_order_does_not_change_the_map(tmpdir):
+    create_sized_files(tmpdir, {"a.foo": 1})
+    tmpdir.mkdir("sub")
+    mapper = fm.IdentityMapper("*", in_path=str(tmpdir), order="largest_first")
+    assert sorted(os.path.basename(str(s)) for s, t in mapper.get_map()) == ["a.foo", "sub"]
+
+def test_order_rejects_unknown_mode():
+    with pytest.raises(RuntimeError) as e:
+        fm.IdentityMapper([], order="random")
+    assert "order" in str(e.value)
+
+def test_parallel_action_packs_chunks_by_size(tmpdir):
+    create_sized_files(tmpdir, {"a.foo": 40, "b.foo": 30, "c.foo": 20, "d.foo": 10})
+    chunks = []
+    original = fm._call_pairs
+    def record_chunks(callback, handled_exceptions, pairs):
+        chunks.append(sorted(os.path.basename(str(s)) for s, t in pairs))
+        return original(callback, handled_exceptions, pairs)
+    mapper = fm.GlobMapper("*.foo", mock.Mock(return_value=True), "*.bar", in_path=str(tmpdir),
+        order="largest_first", execution="thread", workers=1, chunk_size=2)
+    with mock.patch("doitfilemappers.filemappers._call_pairs", side_effect=record_chunks):
+        assert mapper.get_task()["actions"][0](["dummy"])
+    assert chunks == [["a.foo", "d.foo"], ["b.foo", "c.foo"]]
+
+def test_commands_are_ordered_by_size(tmpdir):
+    create_sized_files(tmpdir, {"a.foo": 1, "big.foo": 30})
+    mapper = fm.IdentityMapper(["a.foo", "big.foo"], in_path=str(tmpdir), order="largest_first")
+    commands = mapper.get_cmd_action("process %(source)s")
+    assert [c.replace(str(tmpdir) + os.sep, "") for c in commands] == ["process big.foo", "process a.foo"]
+
+def test_get_tasks_balances_shards_by_size(tmpdir):
+    create_sized_files(tmpdir, {"a.foo": 40, "b.foo": 30, "c.foo": 20, "d.foo": 10})
+    mapper = fm.GlobMapper("*.foo", "cp %(source)s %(target)s", "*.bar", in_path=str(tmpdir), order="largest_first")
+    tasks = list(mapper.get_tasks(shard_size=2))
+    assert [sorted(os.path.basename(f) for f in t["file_dep"]) for t in tasks] == [["a.foo", "d.foo"], ["b.foo", "c.foo"]]
+
+def test_batch_commands_are_balanced_by_size(tmpdir):
+    create_sized_files(tmpdir, {"a.foo": 40, "b.foo": 30, "c.foo": 20, "d.foo": 10})
+    mapper = fm.IdentityMapper(["a.foo", "b.foo", "c.foo", "d.foo"], in_path=str(tmpdir), order="largest_first", batch_size=2)
+    commands = mapper.get_cmd_action("process %(sources)s")
+    assert [c.replace(str(tmpdir) + os.sep, "") for c in commands] == ["process a.foo d.foo", "process b.foo c.foo"]
+
@@ -0,0 +1,135 @@
+import doitfilemappers.filemappers as fm
+import doitfilemappers.walker as walker
+
+import mock
+import pytest
+import pathlib
+
+def create_tree(tmpdir, names):
+    for name in names:
+        tmpdir.join(name).ensure()
+
+def relative_names(paths, root):
+    return sorted(str(p.relative_to(pathlib.Path(str(root)))) for p in paths)
+
+TREE = [
+    "a.json", "b.txt",
+    "sub/c.json", "sub/deeper/d.json",
+    ".git/objects/e.json", "node_modules/pkg/f.json",
+]
+
+def test_filewalker_recursive_glob_matches_pathlib_glob(tmpdir):
+    create_tree(tmpdir, TREE)
+    root = pathlib.Path(str(tmpdir))
+    expected = relative_names([p for p in root.glob("**/*.json")], tmpdir)
+    assert relative_names(walker.FileWalker().glob(root, "**/*.json"), tmpdir) == expected
+
+def test_filewalker_matches_single_directory_glob(tmpdir):
+    create_tree(tmpdir, TREE)
+    found = walker.FileWalker().glob(pathlib.Path(str(tmpdir)), "sub/*.json")
+    assert relative_names(found, tmpdir) == ["sub/c.json"]
+
+def test_filewalker_prunes_excluded_directories(tmpdir):
+    create_tree(tmpdir, TREE)
+    w = walker.FileWalker(exclude=[".git", "node_modules"])
+    with mock.patch.object(w, "_list_entries", wraps=w._list_entries) as list_entries:
+        found = list(w.glob(pathlib.Path(str(tmpdir)), "**/*.json"))
+    assert relative_names(found, tmpdir) == ["a.json", "sub/c.json", "sub/deeper/d.json"]
+    listed = [str(c[0][0]) for c in list_entries.call_args_list]
+    assert not any(".git" in d or "node_modules" in d for d in listed)
+
+def test_filewalker_does_not_read_directories_that_cannot_match(tmpdir):
+    create_tree(tmpdir, TREE)
+    w = walker.FileWalker()
+    with mock.patch.object(w, "_list_entries", wraps=w._list_entries) as list_entries:
+        list(w.glob(pathlib.Path(str(tmpdir)), "*.json"))
+    assert list_entries.call_count == 1
+
+def test_filewalker_respects_max_depth(tmpdir):
+    create_tree(tmpdir, TREE)
+    w = walker.FileWalker(max_depth=1, exclude=[".git", "node_modules"])
+    assert relative_names(w.glob(pathlib.Path(str(tmpdir)), "**/*.json"), tmpdir) == ["a.json", "sub/c.json"]
+
+def test_filewalker_applies_max_depth_to_literal_directories(tmpdir):
+    tmpdir.mkdir("a").mkdir("b").join("x.txt").write("x")
+    path = pathlib.Path(str(tmpdir))
+    assert list(walker.FileWalker(max_depth=0).glob(path, "a/b/*.txt")) == []
+    assert list(walker.FileWalker(max_depth=1).glob(path, "a/b/*.txt")) == []
+    assert relative_names(walker.FileWalker(max_depth=2).glob(path, "a/b/*.txt"), tmpdir) == ["a/b/x.txt"]
+
+def test_filewalker_filters_by_file_type(tmpdir):
+    create_tree(tmpdir, TREE)
+    w = walker.FileWalker(file_type="dir", exclude=[".git", "node_modules"])
+    assert relative_names(w.glob(pathlib.Path(str(tmpdir)), "**/*"), tmpdir) == ["sub", "sub/deeper"]
+
+def test_filewalker_rejects_unknown_file_type():
+    with pytest.raises(RuntimeError) as e:
+        walker.FileWalker(file_type="socket")
+    assert "file_type" in str(e.value)
+
+def test_filewalker_collects_file_sizes(tmpdir):
+    tmpdir.join("a.json").write("12345")
+    tmpdir.join("sub").ensure(dir=True)
+    w = walker.FileWalker(collect_sizes=True, file_type="any")
+    found = list(w.glob(pathlib.Path(str(tmpdir)), "*"))
+    assert len(found) == 2
+    assert w.sizes == {str(tmpdir.join("a.json")): 5}
+
+def test_globmatcher_matches_relative_paths():
+    matcher = walker.GlobMatcher("src/**/*.[ch]")
+    assert matcher.match("src/a.c")
+    assert matcher.match("src/x/y/a.h")
+    assert not matcher.match("src/a.py")
+    assert not matcher.match("lib/a.c")
+
+def test_mapper_uses_walker_for_src_glob(tmpdir):
+    create_tree(tmpdir, TREE)
+    mapper = fm.GlobMapper("**/*.json", None, "*.out", "*.json", in_path=str(tmpdir),
+        walker=walker.FileWalker(exclude=[".git", "node_modules"]))
+    sources = [s for s, t in mapper.get_map()]
+    assert relative_names(sources, tmpdir) == ["a.json", "sub/c.json", "sub/deeper/d.json"]
+
+def test_directoryindex_reads_unchanged_directories_once(tmpdir):
+    create_tree(tmpdir, TREE)
+    index = walker.DirectoryIndex()
+    root = pathlib.Path(str(tmpdir))
+    with mock.patch("doitfilemappers.walker.list_entries", wraps=walker.list_entries) as list_entries:
+        first = relative_names(index.glob(root, "**/*.json"), tmpdir)
+        scans = list_entries.call_count
+        second = relative_names(index.glob(root, "**/*.json"), tmpdir)
+    assert first == second
+    assert list_entries.call_count == scans
+
+def test_directoryindex_rereads_directory_when_mtime_changes(tmpdir):
+    create_tree(tmpdir, ["a.json"])
+    tmpdir.setmtime(1000)
+    index = walker.DirectoryIndex()
+    root = pathlib.Path(str(tmpdir))
+    assert relative_names(index.glob(root, "*.json"), tmpdir) == ["a.json"]
+    create_tree(tmpdir, ["b.json"])
+    tmpdir.setmtime(2000)
+    assert relative_names(index.glob(root, "*.json"), tmpdir) == ["a.json", "b.json"]
+
+def test_directoryindex_answers_regex_queries(tmpdir):
+    create_tree(tmpdir, TREE)
+    index = walker.DirectoryIndex()
+    found = index.search(pathlib.Path(str(tmpdir)), r"^sub/.*\.json$")
+    assert relative_names(found, tmpdir) == ["sub/c.json", "sub/deeper/d.json"]
+
+def test_mappers_share_directory_index(tmpdir):
+    create_tree(tmpdir, TREE)
+    index = walker.DirectoryIndex()
+    m1 = fm.GlobMapper("**/*.json", None, "*.out", "*.json", in_path=str(tmpdir), index=index)
+    m2 = fm.GlobMapper("*.txt", None, "*.out", in_path=str(tmpdir), index=index)
+    with mock.patch("doitfilemappers.walker.list_entries", wraps=walker.list_entries) as list_entries:
+        m1.get_map()
+        scans = list_entries.call_count
+        assert len(m2.get_map()) == 1
+    assert list_entries.call_count == scans
+
+def test_index_keeps_semantics_of_pathlib_glob(tmpdir):
+    tmpdir.mkdir("real").join("a.txt").write("a")
+    tmpdir.join("link").mksymlinkto(tmpdir.join("real"))
+    for pattern in ["*", "*/a.txt"]:
+        expected = sorted(fm.IdentityMapper(pattern, in_path=str(tmpdir)).get_map())
+        assert sorted(fm.IdentityMapper(pattern, in_path=str(tmpdir), index=walker.DirectoryIndex()).get_map()) == expected
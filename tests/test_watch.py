@@ -0,0 +1,115 @@
+import doitfilemappers.filemappers as fm
+from doitfilemappers.walker import FileWalker
+from doitfilemappers.watch import MapperWatcher, Inotify
+
+import pytest
+
+def inotify_available():
+    try:
+        Inotify().close()
+    except (RuntimeError, OSError):
+        return False
+    return True
+
+pytestmark = pytest.mark.skipif(not inotify_available(), reason="inotify is not available")
+
+@fm.open_files
+def upper(_in, _out):
+    _out.write(_in.read().upper())
+
+@fm.open_files_with_merge
+def append(_in, _out):
+    _out.write(_in.read() + "\n")
+
+def start_watcher(mapper, **kwargs):
+    watcher = MapperWatcher(mapper, **kwargs)
+    watcher.start()
+    return watcher
+
+def test_watcher_processes_created_file(tmpdir):
+    tmpdir.join("a.txt").write("a")
+    watcher = start_watcher(fm.GlobMapper("*.txt", upper, "*.out", "*.txt", in_path=str(tmpdir)))
+    tmpdir.join("b.txt").write("b")
+    tmpdir.join("b.log").write("ignored")
+    processed = watcher.poll(1)
+    watcher.close()
+    assert [(str(s), str(t)) for s, t in processed] == [(str(tmpdir.join("b.txt")), str(tmpdir.join("b.out")))]
+    assert tmpdir.join("b.out").read() == "B"
+    assert not tmpdir.join("a.out").exists()
+    assert len(watcher.mapper.get_map()) == 2
+
+def test_watcher_reprocesses_modified_file(tmpdir):
+    tmpdir.join("a.txt").write("a")
+    tmpdir.join("b.txt").write("b")
+    watcher = start_watcher(fm.GlobMapper("*.txt", upper, "*.out", "*.txt", in_path=str(tmpdir)))
+    tmpdir.join("a.txt").write("changed")
+    processed = watcher.poll(1)
+    watcher.close()
+    assert len(processed) == 1
+    assert tmpdir.join("a.out").read() == "CHANGED"
+    assert not tmpdir.join("b.out").exists()
+
+def test_watcher_rebuilds_merged_target(tmpdir):
+    tmpdir.join("a.txt").write("a")
+    target = tmpdir.join("all.out")
+    watcher = start_watcher(fm.MergeMapper("*.txt", append, target=str(target), in_path=str(tmpdir)))
+    tmpdir.join("b.txt").write("b")
+    assert len(watcher.poll(1)) == 2
+    assert target.read() == "a\nb\n"
+    tmpdir.join("a.txt").remove()
+    assert len(watcher.poll(1)) == 1
+    watcher.close()
+    assert target.read() == "b\n"
+
+def test_watcher_deletes_orphaned_targets(tmpdir):
+    tmpdir.join("a.txt").write("a")
+    tmpdir.join("a.out").write("A")
+    watcher = start_watcher(fm.GlobMapper("*.txt", upper, "*.out", "*.txt", in_path=str(tmpdir)), delete_targets=True)
+    tmpdir.join("a.txt").rename(tmpdir.join("a.bak"))
+    assert watcher.poll(1) == []
+    watcher.close()
+    assert not tmpdir.join("a.out").exists()
+    assert watcher.mapper.get_map() == []
+
+def test_watcher_processes_files_in_new_directories(tmpdir):
+    watcher = start_watcher(fm.GlobMapper("**/*.txt", upper, "*.out", "*.txt", in_path=str(tmpdir), allow_empty_map=True))
+    tmpdir.mkdir("sub").join("a.txt").write("a")
+    watcher.poll(1)
+    tmpdir.join("sub", "b.txt").write("b")
+    watcher.poll(1)
+    watcher.close()
+    assert tmpdir.join("sub", "a.out").read() == "A"
+    assert tmpdir.join("sub", "b.out").read() == "B"
+
+def test_watcher_uses_settings_of_file_walker(tmpdir):
+    walker = FileWalker(exclude=["node_modules"], max_depth=1)
+    mapper = fm.GlobMapper("**/*.txt", upper, "*.out", "*.txt", in_path=str(tmpdir), walker=walker, allow_empty_map=True)
+    watcher = start_watcher(mapper)
+    tmpdir.mkdir("node_modules").join("y.txt").write("y")
+    tmpdir.mkdir("sub").mkdir("deep").join("z.txt").write("z")
+    tmpdir.join("sub", "a.txt").write("a")
+    processed = watcher.poll(1)
+    watched = [rel_dir for directory, rel_dir in watcher.watches.values()]
+    watcher.close()
+    assert [str(s) for s, t in processed] == [str(tmpdir.join("sub", "a.txt"))]
+    assert [str(s) for s, t in mapper.get_map()] == [str(tmpdir.join("sub", "a.txt"))]
+    assert sorted(watched) == ["", "sub"]
+
+def test_watcher_passes_targets_to_next_stages(tmpdir):
+    tmpdir.join("a.txt").write("a")
+    tmpdir.join("a.tmp").write("A")
+    mapper = fm.ChainedMapper("*.txt", [
+        fm.GlobMapper(callback=upper, replace="*.tmp", pattern="*.txt"),
+        fm.MergeMapper(callback=append, target=str(tmpdir.join("all.out")))
+    ], in_path=str(tmpdir))
+    watcher = start_watcher(mapper)
+    tmpdir.join("b.txt").write("b")
+    processed = watcher.poll(1)
+    watcher.close()
+    assert [str(t) for s, t in processed] == [str(tmpdir.join("b.tmp"))] + [str(tmpdir.join("all.out"))] * 2
+    assert tmpdir.join("b.tmp").read() == "B"
+    assert tmpdir.join("all.out").read() == "A\nB\n"
+
+def test_watcher_needs_glob_src(tmpdir):
+    with pytest.raises(RuntimeError):
+        MapperWatcher(fm.GlobMapper(["a.txt"], upper, "*.out", "*.txt"))